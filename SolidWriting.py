@@ -1,37 +1,57 @@
 import base64
 import datetime
+import hashlib
+import html
+import itertools
+import json
 import locale
 import mimetypes
+import multiprocessing
 import os
-import re
 import sys
+from collections import OrderedDict
 from functools import partial
 
-import chardet
-import mammoth
 import psutil
-import torch
 from langdetect import DetectorFactory, detect
-from llama_cpp import Llama
-from PySide6.QtCore import (QDir, QMargins, QSettings, QSize, QSizeF, QThread,
-                            QTimer, QUrl, Signal)
-from PySide6.QtGui import (QAction, QColor, QDesktopServices, QFont,
-                           QGuiApplication, QIcon, QKeySequence, QPageLayout,
-                           QPalette, Qt, QTextCharFormat, QTextCursor,
-                           QTextDocument, QTextListFormat, QTransform)
+from llama_cpp import LlamaDiskCache, LlamaRAMCache
+from PySide6.QtCore import (QAbstractListModel, QDir, QMargins, QModelIndex,
+                            QPoint, QPointF, QRectF, QSettings, QSize, QSizeF,
+                            QTimer, QUrl)
+from PySide6.QtGui import (QAbstractTextDocumentLayout, QAction, QColor,
+                           QDesktopServices, QFont, QGuiApplication, QIcon,
+                           QKeySequence, QPageLayout, QPainter, QPalette, Qt,
+                           QTextCharFormat, QTextCursor, QTextDocument,
+                           QTextListFormat, QTransform)
 from PySide6.QtOpenGLWidgets import QOpenGLWidget
 from PySide6.QtPrintSupport import QPrinter, QPrintPreviewDialog
-from PySide6.QtWidgets import (QApplication, QColorDialog, QComboBox, QDialog,
-                               QFileDialog, QFontDialog, QGraphicsScene,
-                               QGraphicsView, QHBoxLayout, QInputDialog,
-                               QLabel, QLineEdit, QMainWindow, QMenu,
-                               QMessageBox, QPushButton, QScrollArea, QStyle,
-                               QTextBrowser, QTextEdit, QToolBar, QVBoxLayout,
-                               QWidget, QWidgetAction)
-
+from PySide6.QtWidgets import (QAbstractItemView, QApplication, QCheckBox,
+                               QColorDialog, QComboBox, QDialog, QFileDialog,
+                               QFontDialog, QGraphicsScene, QGraphicsView,
+                               QHBoxLayout, QInputDialog, QLabel, QLineEdit,
+                               QListView, QListWidget, QMainWindow, QMenu,
+                               QMessageBox,
+                               QProgressBar, QPushButton, QScrollArea,
+                               QStyle, QStyledItemDelegate, QTextBrowser,
+                               QTextEdit, QToolBar, QVBoxLayout, QWidget,
+                               QWidgetAction)
+
+from modules.batch import BatchJob, batchActions
 from modules.crypto import CryptoEngine
+from modules.documents import DocumentEngine
 from modules.globals import fallbackValues, languages, translations
+from modules.hardware import acceleratorBackend
+from modules.headless import headlessCommands, runHeadless
+from modules.imaging import ImageEngine
+from modules.markdown import MarkdownStream, markdownToHtml
+from modules.responses import ResponseCache
+from modules.retrieval import RetrievalIndex
+from modules.inference import (AdaptiveLookupDecoding, ChatSession,
+                               InferenceEngine, InferenceRequest,
+                               contextMessages)
+from modules.statistics import StatisticsEngine
 from modules.threading import ThreadingEngine
+from modules.tuning import InferenceTuner
 
 try:
     from ctypes import windll
@@ -49,26 +69,425 @@ except:
     pass
 
 
-class SW_LLMThread(QThread):
-    result = Signal(str)
+class SW_ChatModel(QAbstractListModel):
+    # Only the newest messages stay in memory, older pages are spilled to a
+    # JSON lines file and read back when the view is scrolled to the top
+    def __init__(self, capacity=200, page=50, parent=None):
+        super(SW_ChatModel, self).__init__(parent)
+        self.capacity = capacity
+        self.page = page
+        self.messages = []
+        self.ids = itertools.count()
+        self.archive_path = os.path.join(
+            fallbackValues["cacheDirectory"], "chat", f"{os.getpid()}-{id(self)}.jsonl"
+        )
+        self.archive_offsets = []
+        self.removeStaleArchives()
+
+    def removeStaleArchives(self):
+        # Archives are named <pid>-<id>.jsonl, those of crashed processes are never cleared
+        directory = os.path.dirname(self.archive_path)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            owner = name.split("-", 1)[0]
+            if owner.isdigit() and psutil.pid_exists(int(owner)):
+                continue
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.messages[index.row()]
+        if role == Qt.DisplayRole:
+            return message["text"]
+        return None
+
+    def message(self, index):
+        # The delegate reads the dict directly, a QVariant round trip would copy it
+        return self.messages[index.row()]
+
+    def row(self, message_id):
+        # Recent messages are the ones being updated, search from the end
+        for row in range(len(self.messages) - 1, -1, -1):
+            if self.messages[row]["id"] == message_id:
+                return row
+        return None
+
+    def changed(self, message_id, rebuild=False):
+        row = self.row(message_id)
+        if row is None:
+            return
+        message = self.messages[row]
+        if rebuild:
+            message["generation"] += 1
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def addMessage(self, text="", is_user=True, html=None):
+        message = {
+            "id": next(self.ids),
+            "user": is_user,
+            "text": text,
+            # (kind, content) pairs, kind is "text" or "html"; layouts only lay out new parts
+            "fragments": [("html", html)] if html is not None else [("text", text)],
+            # Unfinished streamed line, shown as plain text after the fragments
+            "tail": "",
+            "footer": "",
+            "generation": 0,
+        }
+        self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages))
+        self.messages.append(message)
+        self.endInsertRows()
+        if len(self.messages) > self.capacity:
+            self.archive(self.page)
+        return message["id"]
+
+    def appendHtml(self, message_id, html, text="", tail=""):
+        row = self.row(message_id)
+        if row is None:
+            return
+        message = self.messages[row]
+        message["text"] += text
+        if html:
+            message["fragments"].append(("html", html))
+        message["tail"] = tail
+        self.changed(message_id)
+
+    def setMessage(self, message_id, html, text=None):
+        row = self.row(message_id)
+        if row is None:
+            return
+        message = self.messages[row]
+        if text is not None:
+            message["text"] = text
+        message["fragments"] = [("html", html)]
+        message["tail"] = ""
+        self.changed(message_id, rebuild=True)
+
+    def setFooter(self, message_id, note=""):
+        row = self.row(message_id)
+        if row is None:
+            return
+        message = self.messages[row]
+        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        language = ""
 
-    def __init__(self, prompt, llm, parent=None):
-        super(SW_LLMThread, self).__init__(parent)
-        self.prompt = prompt
-        self.llm = llm
+        if len(message["text"]) > 30:
+            try:
+                DetectorFactory.seed = 0
+                language = detect(message["text"])
+            except Exception:
+                language = ""
 
-    def run(self):
-        response = self.getResponseLLM()
-        self.result.emit(response)
+        message["footer"] = " - ".join(
+            part for part in (current_time, language, note) if part
+        )
+        self.changed(message_id, rebuild=True)
 
-    def getResponseLLM(self):
-        try:
-            response = self.llm.create_chat_completion(
-                messages=[{"role": "user", "content": self.prompt}]
+    def messageHtml(self, message):
+        return "".join(
+            content if kind == "html" else html.escape(content).replace("\n", "<br>")
+            for kind, content in message["fragments"]
+        )
+
+    def archive(self, count):
+        os.makedirs(os.path.dirname(self.archive_path), exist_ok=True)
+        with open(self.archive_path, "ab") as file:
+            for message in self.messages[:count]:
+                self.archive_offsets.append(file.tell())
+                record = {
+                    "user": message["user"],
+                    "text": message["text"],
+                    "html": self.messageHtml(message),
+                    "footer": message["footer"],
+                }
+                file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        self.beginRemoveRows(QModelIndex(), 0, count - 1)
+        del self.messages[:count]
+        self.endRemoveRows()
+
+    def loadOlder(self):
+        if not self.archive_offsets:
+            return 0
+
+        offset = self.archive_offsets[-min(self.page, len(self.archive_offsets))]
+        with open(self.archive_path, "r+b") as file:
+            file.seek(offset)
+            lines = file.read().splitlines()
+            file.truncate(offset)
+        del self.archive_offsets[-len(lines) :]
+
+        older = []
+        for line in lines:
+            record = json.loads(line)
+            older.append(
+                {
+                    "id": next(self.ids),
+                    "user": record["user"],
+                    "text": record["text"],
+                    "fragments": [("html", record["html"])],
+                    "tail": "",
+                    "footer": record["footer"],
+                    "generation": 0,
+                }
             )
-            return response["choices"][0]["message"]["content"]
-        except Exception as e:
-            return f"Error: {str(e)}"
+
+        self.beginInsertRows(QModelIndex(), 0, len(older) - 1)
+        self.messages[:0] = older
+        self.endInsertRows()
+        return len(older)
+
+    def clear(self):
+        self.beginResetModel()
+        self.messages = []
+        self.endResetModel()
+        self.archive_offsets = []
+        if os.path.exists(self.archive_path):
+            os.remove(self.archive_path)
+
+
+class SW_ChatDelegate(QStyledItemDelegate):
+    padding = 10
+    margin = 5
+    maxWidth = 400
+
+    def __init__(self, parent=None, capacity=256):
+        super(SW_ChatDelegate, self).__init__(parent)
+        # (message id, width) -> [generation, laid out fragments, QTextDocument,
+        # position of the laid out tail, laid out tail]
+        self.layouts = OrderedDict()
+        self.capacity = capacity
+
+    def textWidth(self):
+        width = self.parent().viewport().width()
+        return max(50, min(self.maxWidth, width - 2 * self.margin) - 2 * self.padding)
+
+    def document(self, message):
+        width = self.textWidth()
+        key = (message["id"], width)
+        entry = self.layouts.get(key)
+
+        if entry is None or entry[0] != message["generation"]:
+            document = QTextDocument()
+            document.setDocumentMargin(0)
+            document.setTextWidth(width)
+            entry = [message["generation"], 0, document, 0, ""]
+            self.layouts[key] = entry
+        self.layouts.move_to_end(key)
+
+        generation, count, document, tail_position, tail = entry
+        fragments = message["fragments"]
+        if count < len(fragments) or tail != message["tail"]:
+            # Streaming appends only lay out the new text and the unfinished line
+            cursor = QTextCursor(document)
+            if count:
+                cursor.setPosition(tail_position)
+                cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+                cursor.removeSelectedText()
+            else:
+                cursor.movePosition(QTextCursor.End)
+            for kind, content in fragments[count:]:
+                if kind == "html":
+                    cursor.insertHtml(content)
+                else:
+                    cursor.insertText(content)
+            entry[3] = cursor.position()
+            cursor.insertText(message["tail"])
+            # A footer change rebuilds the document, so it is only added to fresh ones
+            if message["footer"] and count == 0:
+                cursor.insertHtml(
+                    f"<br><br><span style='font-size:8pt;'>({message['footer']})</span>"
+                )
+            entry[1] = len(fragments)
+            entry[4] = message["tail"]
+
+        while len(self.layouts) > self.capacity:
+            self.layouts.popitem(last=False)
+        return document
+
+    def bubbleRect(self, rect, message, document):
+        width = min(document.idealWidth(), self.textWidth()) + 2 * self.padding
+        height = document.size().height() + 2 * self.padding
+        if message["user"]:
+            left = rect.right() - self.margin - width
+        else:
+            left = rect.left() + self.margin
+        return QRectF(left, rect.top() + self.margin, width, height)
+
+    def sizeHint(self, option, index):
+        document = self.document(index.model().message(index))
+        height = document.size().height() + 2 * (self.padding + self.margin)
+        return QSize(self.parent().viewport().width(), int(height) + 1)
+
+    def paint(self, painter, option, index):
+        message = index.model().message(index)
+        document = self.document(message)
+        rect = self.bubbleRect(option.rect, message, document)
+
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor("#d1e7ff" if message["user"] else "#f1f1f1"))
+        painter.drawRoundedRect(rect, 15, 15)
+        painter.translate(rect.left() + self.padding, rect.top() + self.padding)
+
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette.setColor(QPalette.Text, QColor("#000000"))
+        document.documentLayout().draw(painter, context)
+        painter.restore()
+
+
+class SW_ChatView(QListView):
+    def __init__(self, parent=None):
+        super(SW_ChatView, self).__init__(parent)
+        self.press_position = None
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setResizeMode(QListView.Adjust)
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self.showContextMenu)
+        self.setItemDelegate(SW_ChatDelegate(self))
+        self.verticalScrollBar().valueChanged.connect(self.loadOlder)
+
+    def setModel(self, model):
+        super(SW_ChatView, self).setModel(model)
+        model.dataChanged.connect(self.messageChanged)
+
+    def messageChanged(self, top_left, bottom_right):
+        # Item heights change while answers stream in
+        for row in range(top_left.row(), bottom_right.row() + 1):
+            self.itemDelegate().sizeHintChanged.emit(self.model().index(row))
+
+    def loadOlder(self, value):
+        if value != self.verticalScrollBar().minimum():
+            return
+        loaded = self.model().loadOlder()
+        if loaded:
+            self.scrollTo(self.model().index(loaded), QAbstractItemView.PositionAtTop)
+
+    def anchorAt(self, position):
+        index = self.indexAt(position)
+        if not index.isValid():
+            return None
+        message = index.model().message(index)
+        delegate = self.itemDelegate()
+        document = delegate.document(message)
+        rect = delegate.bubbleRect(self.visualRect(index), message, document)
+        point = QPointF(position) - rect.topLeft() - QPointF(
+            delegate.padding, delegate.padding
+        )
+        return document.documentLayout().anchorAt(point) or None
+
+    def mousePressEvent(self, event):
+        self.press_position = event.position().toPoint()
+        super(SW_ChatView, self).mousePressEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        position = event.position().toPoint()
+        press_position, self.press_position = self.press_position, None
+        # A drag that happens to end on a link is not a click
+        if (
+            press_position is not None
+            and (position - press_position).manhattanLength()
+            < QApplication.startDragDistance()
+        ):
+            anchor = self.anchorAt(position)
+            if anchor:
+                QDesktopServices.openUrl(QUrl(anchor))
+        super(SW_ChatView, self).mouseReleaseEvent(event)
+
+    def showContextMenu(self, position):
+        index = self.indexAt(position)
+        if not index.isValid():
+            return
+        menu = QMenu(self)
+        menu.addAction(
+            "Copy",
+            lambda: QApplication.clipboard().setText(index.data(Qt.DisplayRole)),
+        )
+        menu.exec(self.viewport().mapToGlobal(position))
+
+
+class SW_BatchReview(QDialog):
+    def __init__(self, job, document_area, parent=None):
+        super(SW_BatchReview, self).__init__(parent)
+        self.job = job
+        self.document_area = document_area
+        self.annotations = []
+        self.setWindowTitle(batchActions[job.action])
+        self.resize(720, 480)
+
+        self.unit_list = QListWidget()
+        self.unit_list.currentRowChanged.connect(self.showAnnotation)
+        self.result_view = QTextBrowser()
+        self.result_view.setOpenExternalLinks(True)
+
+        panes = QHBoxLayout()
+        panes.addWidget(self.unit_list, 1)
+        panes.addWidget(self.result_view, 2)
+
+        goto_button = QPushButton("Go to")
+        goto_button.clicked.connect(self.goTo)
+        dismiss_button = QPushButton("Dismiss")
+        dismiss_button.clicked.connect(self.dismiss)
+        close_button = QPushButton("Close")
+        close_button.clicked.connect(self.close)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(goto_button)
+        buttons.addWidget(dismiss_button)
+        buttons.addStretch()
+        buttons.addWidget(close_button)
+
+        layout = QVBoxLayout(self)
+        layout.addLayout(panes)
+        layout.addLayout(buttons)
+        self.refresh()
+
+    def refresh(self):
+        row = max(0, self.unit_list.currentRow())
+        self.annotations = self.job.annotations()
+        self.unit_list.clear()
+        for unit, _ in self.annotations:
+            line = unit.split("\n", 1)[0]
+            self.unit_list.addItem(line[:80] + ("..." if len(line) > 80 else ""))
+        if self.annotations:
+            self.unit_list.setCurrentRow(min(row, len(self.annotations) - 1))
+        else:
+            self.result_view.setHtml("No annotations left to review.")
+
+    def showAnnotation(self, row):
+        if 0 <= row < len(self.annotations):
+            self.result_view.setHtml(markdownToHtml(self.annotations[row][1]))
+
+    def goTo(self):
+        row = self.unit_list.currentRow()
+        if not 0 <= row < len(self.annotations):
+            return
+        # QTextDocument.find does not cross paragraphs, sections are found by their first line
+        cursor = self.document_area.document().find(
+            self.annotations[row][0].split("\n", 1)[0]
+        )
+        if not cursor.isNull():
+            self.document_area.setTextCursor(cursor)
+            self.document_area.ensureCursorVisible()
+
+    def dismiss(self):
+        row = self.unit_list.currentRow()
+        if 0 <= row < len(self.annotations):
+            self.job.dismiss(self.annotations[row][0])
+            self.refresh()
 
 
 class SW_ControlInfo(QMainWindow):
@@ -142,7 +561,7 @@ class SW_About(QMainWindow):
             "Made by Berkay Gediz<br><br>"
             "GNU General Public License v3.0<br>GNU LESSER GENERAL PUBLIC LICENSE v3.0<br>Mozilla Public License Version 2.0<br><br>"
             "<b>Libraries: </b>mwilliamson/python-mammoth, Mimino666/langdetect, abetlen/llama-cpp-python, <br>"
-            "pytorch/pytorch, PySide6, chardet, psutil<br><br>"
+            "PySide6, chardet, psutil<br><br>"
             "OpenGL: <b>ON</b>"
             "</center>"
         )
@@ -254,6 +673,203 @@ class SW_Help(QMainWindow):
         self.setCentralWidget(scroll_area)
 
 
+class SW_DocumentArea(QTextBrowser):
+    def __init__(self, image_engine, parent=None):
+        super(SW_DocumentArea, self).__init__(parent)
+        self.image_engine = image_engine
+        self.image_scale = 1.0
+        self.decoded_images = set()
+        # Inline AI suggestion painted after the cursor, it is not part of the document
+        self.ghost_text = ""
+
+        self.image_timer = QTimer(self)
+        self.image_timer.setSingleShot(True)
+        self.image_timer.setInterval(100)
+        self.image_timer.timeout.connect(self.updateVisibleImages)
+        self.verticalScrollBar().valueChanged.connect(
+            lambda _: self.image_timer.start()
+        )
+
+    def setHtml(self, html):
+        self.decoded_images.clear()
+        self.image_engine.clear()
+        super(SW_DocumentArea, self).setHtml(html)
+        self.image_timer.start()
+
+    def setPlainText(self, text):
+        self.decoded_images.clear()
+        self.image_engine.clear()
+        super(SW_DocumentArea, self).setPlainText(text)
+
+    def setMarkdown(self, markdown):
+        self.decoded_images.clear()
+        self.image_engine.clear()
+        super(SW_DocumentArea, self).setMarkdown(markdown)
+        self.image_timer.start()
+
+    def clear(self):
+        self.decoded_images.clear()
+        self.image_engine.clear()
+        super(SW_DocumentArea, self).clear()
+
+    def loadResource(self, type, name):
+        # Images are laid out with a low-resolution placeholder and decoded once visible
+        if (
+            QTextDocument.ResourceType(type) == QTextDocument.ImageResource
+            and name.scheme() == "data"
+        ):
+            url = name.toString()
+            source = self.image_engine.source(url)
+            if source is not None:
+                self.image_timer.start()
+                return self.image_engine.placeholderImage(
+                    url, self.image_engine.displaySize(source[1], self.imageMaxWidth())
+                )
+        return super(SW_DocumentArea, self).loadResource(type, name)
+
+    def resizeEvent(self, event):
+        super(SW_DocumentArea, self).resizeEvent(event)
+        self.image_timer.start()
+
+    def setGhostText(self, text):
+        if text != self.ghost_text:
+            self.ghost_text = text
+            self.viewport().update()
+
+    def keyPressEvent(self, event):
+        if self.ghost_text and event.modifiers() == Qt.NoModifier:
+            if event.key() == Qt.Key_Tab:
+                text = self.ghost_text
+                self.setGhostText("")
+                self.insertPlainText(text)
+                event.accept()
+                return
+            elif event.key() == Qt.Key_Escape:
+                self.setGhostText("")
+                event.accept()
+                return
+        super(SW_DocumentArea, self).keyPressEvent(event)
+
+    def focusOutEvent(self, event):
+        self.setGhostText("")
+        super(SW_DocumentArea, self).focusOutEvent(event)
+
+    def paintEvent(self, event):
+        super(SW_DocumentArea, self).paintEvent(event)
+        if not self.ghost_text:
+            return
+
+        rect = self.cursorRect()
+        painter = QPainter(self.viewport())
+        painter.setFont(self.currentFont())
+        painter.setPen(QColor("#9e9e9e"))
+        painter.drawText(
+            QRectF(
+                rect.right() + 1,
+                rect.top(),
+                max(0, self.viewport().width() - rect.right() - 1),
+                rect.height(),
+            ),
+            Qt.AlignLeft | Qt.AlignVCenter | Qt.TextSingleLine,
+            self.ghost_text,
+        )
+        painter.end()
+
+    def imageMaxWidth(self):
+        return self.viewport().width() - 2 * self.document().documentMargin()
+
+    def setImageScale(self, scale):
+        if scale != self.image_scale:
+            self.image_scale = scale
+            self.decoded_images.clear()
+        self.updateVisibleImages()
+
+    def registerImage(self, url, logical_size):
+        image = self.image_engine.scaledImage(url, logical_size, self.image_scale)
+        if image is not None:
+            self.document().addResource(QTextDocument.ImageResource, QUrl(url), image)
+            self.decoded_images.add(url)
+
+    def print_(self, printer):
+        # clone() copies the screen-resolution and placeholder resources, the
+        # printed copy gets the original image data instead
+        document = self.document().clone()
+        printed = set()
+        for url, logical_size in self.imageFragments(0, self.document().characterCount()):
+            if url in printed:
+                continue
+            printed.add(url)
+            source = self.image_engine.source(url)
+            if source is None:
+                continue
+            if not logical_size.width() or not logical_size.height():
+                logical_size = self.image_engine.displaySize(
+                    source[1], self.imageMaxWidth()
+                )
+            image = self.image_engine.originalImage(url, logical_size)
+            if image is not None:
+                document.addResource(QTextDocument.ImageResource, QUrl(url), image)
+        document.print_(printer)
+
+    def imageFragments(self, start, end):
+        block = self.document().findBlock(start)
+        while block.isValid() and block.position() <= end:
+            it = block.begin()
+            while not it.atEnd():
+                char_format = it.fragment().charFormat()
+                if char_format.isImageFormat():
+                    image_format = char_format.toImageFormat()
+                    yield image_format.name(), QSize(
+                        int(image_format.width()), int(image_format.height())
+                    )
+                it += 1
+            block = block.next()
+
+    def updateVisibleImages(self):
+        viewport = self.viewport().rect()
+        margin = viewport.height()
+        start = self.cursorForPosition(QPoint(0, -margin)).position()
+        end = self.cursorForPosition(
+            QPoint(viewport.width(), viewport.height() + margin)
+        ).position()
+
+        visible = set()
+        for url, logical_size in self.imageFragments(start, end):
+            visible.add(url)
+            if url in self.decoded_images:
+                continue
+            source = self.image_engine.source(url)
+            if source is None:
+                continue
+            if not logical_size.width() or not logical_size.height():
+                logical_size = self.image_engine.displaySize(
+                    source[1], self.imageMaxWidth()
+                )
+            self.registerImage(url, logical_size)
+
+        if (
+            self.image_engine.cache_bytes > self.image_engine.max_bytes // 2
+            or psutil.virtual_memory().percent > 85
+        ):
+            self.evictImages(self.decoded_images - visible)
+
+        self.viewport().update()
+
+    def evictImages(self, urls):
+        for url in urls:
+            source = self.image_engine.source(url)
+            if source is None:
+                continue
+            placeholder = self.image_engine.placeholderImage(
+                url, self.image_engine.displaySize(source[1], self.imageMaxWidth())
+            )
+            self.document().addResource(
+                QTextDocument.ImageResource, QUrl(url), placeholder
+            )
+            self.image_engine.evict(source[0])
+            self.decoded_images.discard(url)
+
+
 class SW_Workspace(QMainWindow):
     def __init__(self, parent=None):
         super(SW_Workspace, self).__init__(parent)
@@ -293,13 +909,37 @@ class SW_Workspace(QMainWindow):
         self.is_saved = None
         self.default_directory = QDir().homePath()
         self.directory = self.default_directory
-        self.llm = None
+        self.llm_requests = []
+        self.llm_load_request = None
+        self.llm_index_request = None
+        self.llm_profile = None
+        self.retrieval_index = RetrievalIndex()
+        self.llm_model_path = None
+        self.llm_session = ChatSession()
+        self.inference_engine = InferenceEngine()
+        self.inference_engine.start()
+        self.image_engine = ImageEngine()
+        self.document_engine = DocumentEngine()
+        self.statistics_engine = StatisticsEngine()
+        self.save_hashes = {}
+        self.state_revision = None
         self.hardwareCore = self.acceleratorHardware()
 
         self.LLMinitBar()
         self.ai_widget.hide()
 
         self.status_bar = self.statusBar()
+        self.llm_progress = QProgressBar()
+        self.llm_progress.setRange(0, 100)
+        self.llm_progress.setFormat("LLM %p%")
+        self.llm_progress.setMaximumWidth(160)
+        self.llm_progress.hide()
+        self.status_bar.addPermanentWidget(self.llm_progress)
+        self.inference_engine.loadProgress.connect(self.LLMloadProgress)
+        self.llm_idle_timer = QTimer()
+        self.llm_idle_timer.setSingleShot(True)
+        self.llm_idle_timer.timeout.connect(self.LLMunloadIdle)
+        self.LLMupdateActions()
 
         self.graphicsView = QGraphicsView(self)
         self.graphicsScene = QGraphicsScene(self.graphicsView)
@@ -309,7 +949,7 @@ class SW_Workspace(QMainWindow):
         self.graphicsView.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
         self.graphicsView.setResizeAnchor(QGraphicsView.AnchorUnderMouse)
 
-        self.DocumentArea = QTextBrowser()
+        self.DocumentArea = SW_DocumentArea(self.image_engine)
         self.DocumentArea.setReadOnly(True)
         self.DocumentArea.setUndoRedoEnabled(True)
         self.DocumentArea.setOpenExternalLinks(True)
@@ -333,7 +973,31 @@ class SW_Workspace(QMainWindow):
         self.text_changed_timer = QTimer()
         self.text_changed_timer.setInterval(150 * self.adaptiveResponse)
         self.text_changed_timer.timeout.connect(self.threadStart)
+        self.image_refresh_timer = QTimer()
+        self.image_refresh_timer.setSingleShot(True)
+        self.image_refresh_timer.setInterval(150 * self.adaptiveResponse)
+        self.image_refresh_timer.timeout.connect(self.refreshImageResources)
+        self.index_timer = QTimer()
+        self.index_timer.setSingleShot(True)
+        self.index_timer.setInterval(2000 * self.adaptiveResponse)
+        self.index_timer.timeout.connect(self.LLMindexDocument)
+        self.completion_timer = QTimer()
+        self.completion_timer.setSingleShot(True)
+        self.completion_timer.setInterval(400 * self.adaptiveResponse)
+        self.completion_timer.timeout.connect(self.LLMautocomplete)
+        self.completion_request = None
+        self.batch_job = None
+        self.batch_request = None
+        self.batch_review = None
+        self.selection_timer = QTimer()
+        self.selection_timer.setSingleShot(True)
+        self.selection_timer.setInterval(300 * self.adaptiveResponse)
+        self.selection_timer.timeout.connect(self.LLMcountSelection)
+        self.DocumentArea.selectionChanged.connect(self.selection_timer.start)
         self.DocumentArea.textChanged.connect(self.textChanged)
+        self.DocumentArea.textChanged.connect(self.LLMscheduleIndex)
+        self.DocumentArea.textChanged.connect(self.LLMscheduleAutocomplete)
+        self.DocumentArea.cursorPositionChanged.connect(self.LLMcancelAutocomplete)
         self.thread_running = False
 
         self.showMaximized()
@@ -346,8 +1010,10 @@ class SW_Workspace(QMainWindow):
         self.DocumentArea.setDisabled(False)
         self.updateTitle()
         endtime = datetime.datetime.now()
+        rss = psutil.Process().memory_info().rss / (1024**2)
         self.status_bar.showMessage(
-            str((endtime - starttime).total_seconds()) + " ms", 2500
+            f"{(endtime - starttime).total_seconds() * 1000:.0f} ms, {rss:.0f} MB",
+            2500,
         )
         load_llm = settings.value("load_llm")
         if load_llm is True or load_llm is None:
@@ -375,6 +1041,7 @@ class SW_Workspace(QMainWindow):
             self.zoom_level_combobox.setCurrentText(f"{closest_zoom}%")
             self.zoom_level_combobox.blockSignals(False)
             settings.setValue("zoomLevel", closest_zoom)
+            self.image_refresh_timer.start()
         else:
             event.ignore()
 
@@ -438,7 +1105,14 @@ class SW_Workspace(QMainWindow):
         selected_text = self.DocumentArea.textCursor().selectedText().strip()
         text_length = len(selected_text)
 
-        show_ai = self.llm is not None and self.llm != ""
+        show_ai = self.llm_model_path is not None
+        # Counted in the background once the selection settles, characters until then
+        tokens = self.inference_engine.cachedTokenCount(self.LLMselectedText())
+        selected_label = (
+            f"Selected ({tokens} tokens)"
+            if tokens is not None
+            else f"Selected ({text_length})"
+        )
 
         self.context_menu = QMenu(self)
 
@@ -556,7 +1230,7 @@ class SW_Workspace(QMainWindow):
 
             if text_length < 50:
                 self.context_menu.addAction(
-                    f"Selected ({text_length})",
+                    selected_label,
                     lambda: self.LLMcontextPredict(""),
                 )
                 self.context_menu.addAction(
@@ -564,7 +1238,7 @@ class SW_Workspace(QMainWindow):
                 )
             elif 50 <= text_length < 200:
                 self.context_menu.addAction(
-                    f"Selected ({text_length})",
+                    selected_label,
                     lambda: self.LLMcontextPredict("selected"),
                 )
                 self.context_menu.addAction(
@@ -575,7 +1249,7 @@ class SW_Workspace(QMainWindow):
                 )
             else:
                 self.context_menu.addAction(
-                    f"Selected ({text_length})",
+                    selected_label,
                     lambda: self.LLMcontextPredict("selected"),
                 )
                 self.context_menu.addAction(
@@ -611,7 +1285,7 @@ class SW_Workspace(QMainWindow):
 
             if text_length < 50:
                 self.context_menu.addAction(
-                    f"Selected ({text_length})",
+                    selected_label,
                     lambda: self.LLMcontextPredict(""),
                 )
                 self.context_menu.addAction(
@@ -619,7 +1293,7 @@ class SW_Workspace(QMainWindow):
                 )
             elif 50 <= text_length < 200:
                 self.context_menu.addAction(
-                    f"Selected ({text_length})",
+                    selected_label,
                     lambda: self.LLMcontextPredict(""),
                 )
                 self.context_menu.addAction(
@@ -630,7 +1304,7 @@ class SW_Workspace(QMainWindow):
                 )
             else:
                 self.context_menu.addAction(
-                    f"Selected ({text_length})",
+                    selected_label,
                     lambda: self.LLMcontextPredict(""),
                 )
                 self.context_menu.addAction(
@@ -659,12 +1333,18 @@ class SW_Workspace(QMainWindow):
 
             if reply == QMessageBox.Yes:
                 self.saveState()
+                self.inference_engine.stop()
+                self.LLMsaveSession()
+                self.chat_model.clear()
                 event.accept()
             else:
                 self.saveState()
                 event.ignore()
         else:
             self.saveState()
+            self.inference_engine.stop()
+            self.LLMsaveSession()
+            self.chat_model.clear()
             event.accept()
 
     def languageFallbackIndex(self):
@@ -720,31 +1400,20 @@ class SW_Workspace(QMainWindow):
         self.text_changed_timer.stop()
         self.thread_running = False
         text = self.DocumentArea.toPlainText()
-
-        character_count = len(text)
-        word_count = len(text.split())
-        line_count = text.count("\n") + 1
-
-        avg_word_length = avg_line_length = uppercase_count = lowercase_count = None
-        detected_language = None
+        result = self.statistics_engine.compute(text)
+
+        character_count = result["characters"]
+        word_count = result["words"]
+        line_count = result["lines"]
+        avg_word_length = result["avg_word_length"]
+        uppercase_count = result["uppercase"]
+        lowercase_count = result["lowercase"]
+        detected_language = result["language"]
         lang = settings.value("appLanguage", "1252")
 
-        if word_count > 0 and line_count > 0 and character_count > 0 and text != "":
-            avg_word_length = sum(len(word) for word in text.split()) / word_count
+        if avg_word_length is not None:
             formatted_avg_word_length = "{:.1f}".format(avg_word_length)
-
-            avg_line_length = (character_count / line_count) - 1
-            formatted_avg_line_length = "{:.1f}".format(avg_line_length)
-
-            uppercase_count = sum(1 for char in text if char.isupper())
-            lowercase_count = sum(1 for char in text if char.islower())
-
-            if word_count > 20:
-                try:
-                    DetectorFactory.seed = 0
-                    detected_language = detect(text)
-                except Exception:
-                    detected_language = None
+            formatted_avg_line_length = "{:.1f}".format(result["avg_line_length"])
 
         statistics = f"<html><head><style>"
         statistics += "table {border-collapse: collapse; width: 100%;}"
@@ -798,13 +1467,16 @@ class SW_Workspace(QMainWindow):
         self.updateTitle()
 
     def saveState(self):
-        encryption = CryptoEngine("SolidWriting")
-        encrypted_content = encryption.b64_encrypt(self.DocumentArea.toHtml())
+        revision = self.DocumentArea.document().revision()
+        if revision != self.state_revision:
+            encryption = CryptoEngine("SolidWriting")
+            encrypted_content = encryption.b64_encrypt(self.DocumentArea.toHtml())
+            settings.setValue("content", encrypted_content)
+            self.state_revision = revision
 
         settings.setValue("windowScale", self.saveGeometry())
         settings.setValue("defaultDirectory", self.directory)
         settings.setValue("fileName", self.file_name)
-        settings.setValue("content", encrypted_content)
         settings.setValue("isSaved", self.is_saved)
         settings.setValue(
             "scrollPosition", self.DocumentArea.verticalScrollBar().value()
@@ -827,6 +1499,8 @@ class SW_Workspace(QMainWindow):
         if encrypted_content:
             decrypted_content = encryption.b64_decrypt(encrypted_content)
             self.DocumentArea.setHtml(decrypted_content)
+            # The stored state already holds this content, closing unchanged skips re-encrypting
+            self.state_revision = self.DocumentArea.document().revision()
 
         self.is_saved = settings.value("isSaved")
         index = self.language_combobox.findData(lang)
@@ -1076,66 +1750,198 @@ class SW_Workspace(QMainWindow):
             settings.setValue("load_llm", False)
 
     def _load_model(self):
-        try:
-            model_filename, _ = QFileDialog.getOpenFileName(
-                None,
-                "Select GGUF Model File",
-                "",
-                "GGUF files (*.gguf)",
+        model_filename, _ = QFileDialog.getOpenFileName(
+            None,
+            "Select GGUF Model File",
+            "",
+            "GGUF files (*.gguf)",
+        )
+
+        if not model_filename:
+            return
+
+        current_directory = os.getcwd()
+        model_path = os.path.join(current_directory, model_filename)
+
+        if not os.path.exists(model_path):
+            return
+
+        # Thread, batch and context sizes come from the tuner profile
+        options = {
+            "n_gpu_layers": 0 if self.hardwareCore == "cpu" else -1,
+            "offload_kqv": True,
+            "flash_attn": True,
+            "seed": 0,
+            "use_mmap": settings.value("llmUseMmap", True, type=bool),
+            "use_mlock": settings.value("llmUseMlock", False, type=bool),
+            "verbose": True,
+        }
+        if settings.value("llmServer", False, type=bool):
+            options["server"] = True
+        elif settings.value("llmPromptLookup", False, type=bool):
+            # Drafting needs logits for every position, llama enables logits_all
+            options["draft_model"] = AdaptiveLookupDecoding()
+        cache = self.LLMprefixCache()
+        response_cache = ResponseCache(
+            os.path.join(fallbackValues["cacheDirectory"], "responses"),
+            int(settings.value("llmResponseCacheMB", 64)) * 1024 * 1024,
+        )
+
+        # Loading a multi-GB model takes a while, the worker reports progress instead
+        request = InferenceRequest(
+            priority=InferenceEngine.priorityInteractive,
+            task=partial(
+                self.LLMloadTask, model_path, options, cache, response_cache
+            ),
+            needs_model=False,
+        )
+        request.completed.connect(partial(self.LLMmodelLoaded, model_path, request))
+
+        # Switching models keeps the chat of the previous one
+        self.LLMsaveSession()
+        self.llm_idle_timer.stop()
+        self.inference_engine.embedding_model_path = (
+            settings.value("llmEmbeddingModel") or None
+        )
+        self.llm_model_path = None
+        self.llm_load_request = request
+        self.LLMupdateActions()
+        self.llm_progress.setValue(0)
+        self.llm_progress.show()
+        self.stop_button.setEnabled(True)
+        self.inference_engine.submit(request)
+
+    def LLMloadTask(self, model_path, options, cache, response_cache, llm):
+        model_key = ResponseCache.modelFingerprint(model_path)
+        tuner = InferenceTuner(
+            offload=options["n_gpu_layers"] != 0,
+            logits_all="draft_model" in options,
+        )
+        profile = tuner.loadProfile(model_key) or tuner.initialProfile(model_path)
+
+        self.inference_engine.loadModel(
+            model_path, cache, **options, **tuner.loadOptions(profile)
+        )
+
+        local = self.inference_engine.isLocal()
+        if local and not profile.get("calibrated"):
+            request = self.inference_engine.active
+            calibrated = tuner.calibrate(
+                self.inference_engine.llm,
+                profile,
+                self.inference_engine.loadProgress.emit,
+                request.isCancelled,
             )
+            if calibrated is not None:
+                profile = calibrated
+                tuner.saveProfile(model_key, profile)
+        if local:
+            tuner.apply(self.inference_engine.llm, profile)
+        # Reloads after an idle unload come back with the tuned values
+        self.inference_engine.model_options.update(tuner.loadOptions(profile))
+
+        self.inference_engine.setResponseCache(response_cache, model_key)
+        self.llm_profile = profile
+        return ""
+
+    def LLMmodelLoaded(self, model_path, request, response):
+        if request is self.llm_load_request:
+            self.llm_load_request = None
+        self.llm_progress.hide()
+        self.stop_button.setEnabled(bool(self.llm_requests))
+
+        if response or self.inference_engine.llm is None:
+            self.status_bar.showMessage(response or "Model loading stopped.", 5000)
+            self.LLMupdateActions()
+            return
 
-            if not model_filename:
-                return
+        self.llm_model_path = model_path
+        if not self.inference_engine.isLocal():
+            # The server backend cannot embed, vectors of an earlier model are stale
+            self.retrieval_index.clear()
+        self.inference_engine.submit(
+            InferenceRequest(
+                priority=InferenceEngine.priorityBackground,
+                task=self.inference_engine.warmPrefix,
+            )
+        )
+        self.LLMrestoreSession()
+        self.LLMupdateActions()
+        self.LLMscheduleIndex()
+        self.LLMresumeBatch()
+        self.LLMrestartIdleTimer()
+        profile = self.llm_profile
+        self.status_bar.showMessage(
+            f"{os.path.basename(model_path)} - {profile['n_threads']} threads, "
+            f"batch {profile['n_batch']}, context {profile['n_ctx']}",
+            5000,
+        )
 
-            current_directory = os.getcwd()
-            model_path = os.path.join(current_directory, model_filename)
+    def LLMloadProgress(self, progress):
+        # Also driven by transparent reloads, which have no load request
+        self.llm_progress.setValue(int(progress * 100))
+        self.llm_progress.setVisible(
+            progress < 1.0 or self.llm_load_request is not None
+        )
 
-            if os.path.exists(model_path):
-                if torch.accelerator.is_available() == False:
-                    # max_memory = torch.cuda.get_device_properties(0).total_memory / (
-                    #     1024**2
-                    # )  # x MB VRAM
-                    max_memory = 8192
-                else:
-                    available_memory = psutil.virtual_memory().available
-                    max_memory = min(available_memory, 4 * 1024 * 1024 * 1024) / (
-                        1024**2
-                    )  # 4096 MB
-
-                self.llm = Llama(
-                    model_path,
-                    n_gpu_layers=-1,
-                    offload_kqv=True,
-                    flash_attn=True,
-                    seed=0,
-                    n_threads=4,
-                    max_memory=max_memory,
-                    device_map="auto",
-                    verbose=True,
-                )
+    def LLMrestartIdleTimer(self):
+        minutes = int(settings.value("llmIdleMinutes", 15))
+        if minutes > 0 and self.llm_model_path is not None:
+            self.llm_idle_timer.start(minutes * 60 * 1000)
 
-            else:
-                self.llm = None
-        except TypeError as e:
-            print(f"Error: {str(e)}")
-        except Exception as e:
-            print(f"{str(e)}")
+    def LLMunloadIdle(self):
+        if (
+            self.llm_requests
+            or self.llm_load_request is not None
+            or self.batch_request is not None
+        ):
+            self.LLMrestartIdleTimer()
+            return
+
+        minutes = int(settings.value("llmIdleMinutes", 15))
+        request = InferenceRequest(
+            priority=InferenceEngine.priorityBackground,
+            task=partial(self.inference_engine.unloadModel, minutes * 60),
+            needs_model=False,
+        )
+        request.completed.connect(self.LLMmodelUnloaded)
+        self.inference_engine.submit(request)
+
+    def LLMmodelUnloaded(self, response):
+        if not self.inference_engine.isResident():
+            self.status_bar.showMessage(
+                "Model unloaded while idle, it reloads on the next AI request.", 5000
+            )
+
+    def LLMupdateActions(self):
+        # AI actions stay disabled until a model is ready
+        ready = self.llm_model_path is not None
+        busy = bool(self.llm_requests)
+        self.predict_button.setEnabled(ready and not busy)
+        self.predict_button.setText("..." if busy else "->")
+        if self.llm_load_request is not None:
+            self.predict_button.setText("Loading model...")
+
+    def LLMprefixCache(self):
+        kind = settings.value("llmPrefixCache", "ram")
+        capacity = int(settings.value("llmPrefixCacheMB", 1024)) * 1024 * 1024
+
+        if kind == "disk":
+            return LlamaDiskCache(
+                cache_dir=os.path.join(fallbackValues["cacheDirectory"], "prompts"),
+                capacity_bytes=capacity,
+            )
+        elif kind == "ram":
+            return LlamaRAMCache(capacity_bytes=capacity)
+        return None
 
     def acceleratorHardware(self):
-        if torch.cuda.is_available():  # NVIDIA
-            QTimer.singleShot(500, self.loadLLM)
-            return "cuda"
-        elif torch.is_vulkan_available():
-            QTimer.singleShot(500, self.loadLLM)
-            return "vulkan"
-        elif torch.backends.mps.is_available():  # Metal API
-            QTimer.singleShot(500, self.loadLLM)
-            return "mps"
-        elif hasattr(torch.backends, "rocm"):  # AMD
+        backend = acceleratorBackend(
+            settings.value("acceleratorProbeTorch", False, type=bool)
+        )
+        if backend != "cpu":
             QTimer.singleShot(500, self.loadLLM)
-            return "rocm"
-        else:  # CPU
-            return "cpu"
+        return backend
 
     def LLMwarningCPU(self):
         message = (
@@ -1250,6 +2056,14 @@ class SW_Workspace(QMainWindow):
         )
         main_layout.addWidget(self.predict_button)
 
+        self.stop_button = QPushButton("STOP")
+        self.stop_button.setStyleSheet(
+            "background-color: #444444; color: white; font-weight: bold; border-radius: 5px;"
+        )
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.LLMstop)
+        main_layout.addWidget(self.stop_button)
+
         self.clear_button = QPushButton("DEL")
         self.clear_button.setStyleSheet(
             "background-color: red; color: white; font-weight: bold; border-radius: 5px;"
@@ -1257,18 +2071,132 @@ class SW_Workspace(QMainWindow):
         self.clear_button.clicked.connect(self.clearMessages)
         main_layout.addWidget(self.clear_button)
 
-        self.scrollableArea = QScrollArea()
-        self.scrollableArea.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-        self.scrollableArea.setHorizontalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-        self.scrollableArea.setWidgetResizable(True)
+        self.persist_checkbox = QCheckBox("Remember chat")
+        self.persist_checkbox.setStyleSheet("color: white;")
+        self.persist_checkbox.setChecked(
+            settings.value("llmPersistSessions", False, type=bool)
+        )
+        self.persist_checkbox.toggled.connect(
+            lambda checked: settings.setValue("llmPersistSessions", checked)
+        )
 
-        self.messages_layout = QVBoxLayout()
+        self.mmap_checkbox = QCheckBox("Memory-map model")
+        self.mmap_checkbox.setStyleSheet("color: white;")
+        self.mmap_checkbox.setChecked(settings.value("llmUseMmap", True, type=bool))
+        self.mmap_checkbox.toggled.connect(
+            lambda checked: settings.setValue("llmUseMmap", checked)
+        )
+
+        self.mlock_checkbox = QCheckBox("Lock model in RAM")
+        self.mlock_checkbox.setStyleSheet("color: white;")
+        self.mlock_checkbox.setChecked(settings.value("llmUseMlock", False, type=bool))
+        self.mlock_checkbox.toggled.connect(
+            lambda checked: settings.setValue("llmUseMlock", checked)
+        )
 
-        scroll_contents = QWidget()
-        scroll_contents.setLayout(self.messages_layout)
-        self.scrollableArea.setWidget(scroll_contents)
+        self.document_checkbox = QCheckBox("Use document")
+        self.document_checkbox.setStyleSheet("color: white;")
+        self.document_checkbox.setChecked(
+            settings.value("llmDocumentContext", True, type=bool)
+        )
+        self.document_checkbox.toggled.connect(
+            lambda checked: settings.setValue("llmDocumentContext", checked)
+        )
+        self.document_checkbox.toggled.connect(self.LLMscheduleIndex)
 
-        main_layout.addWidget(self.scrollableArea)
+        self.metrics_checkbox = QCheckBox("Show metrics")
+        self.metrics_checkbox.setStyleSheet("color: white;")
+        self.metrics_checkbox.setChecked(
+            settings.value("llmShowMetrics", False, type=bool)
+        )
+        self.metrics_checkbox.toggled.connect(
+            lambda checked: settings.setValue("llmShowMetrics", checked)
+        )
+
+        self.autocomplete_checkbox = QCheckBox("Autocomplete")
+        self.autocomplete_checkbox.setStyleSheet("color: white;")
+        self.autocomplete_checkbox.setToolTip(
+            "Suggest the rest of the line while typing, Tab accepts"
+        )
+        self.autocomplete_checkbox.setChecked(
+            settings.value("llmAutocomplete", False, type=bool)
+        )
+        self.autocomplete_checkbox.toggled.connect(
+            lambda checked: settings.setValue("llmAutocomplete", checked)
+        )
+        self.autocomplete_checkbox.toggled.connect(self.LLMcancelAutocomplete)
+
+        self.metrics_button = QPushButton("LOG")
+        self.metrics_button.setToolTip("Export inference metrics as JSON")
+        self.metrics_button.setStyleSheet(
+            "background-color: #444444; color: white; font-weight: bold; border-radius: 5px;"
+        )
+        self.metrics_button.clicked.connect(self.LLMexportMetrics)
+
+        self.batch_button = QPushButton("BATCH")
+        self.batch_button.setToolTip("Run an AI action over the whole document")
+        self.batch_button.setStyleSheet(
+            "background-color: #444444; color: white; font-weight: bold; border-radius: 5px;"
+        )
+        batch_menu = QMenu(self.batch_button)
+        for action, title in batchActions.items():
+            batch_menu.addAction(title, partial(self.LLMstartBatch, action))
+        batch_menu.addSeparator()
+        batch_menu.addAction("Review annotations", self.LLMreviewBatch)
+        batch_menu.addAction("Stop batch", self.LLMstopBatch)
+        self.batch_button.setMenu(batch_menu)
+
+        options_layout = QHBoxLayout()
+        options_layout.addWidget(self.persist_checkbox)
+        options_layout.addWidget(self.document_checkbox)
+        options_layout.addWidget(self.metrics_checkbox)
+        options_layout.addWidget(self.autocomplete_checkbox)
+        options_layout.addWidget(self.metrics_button)
+        options_layout.addWidget(self.batch_button)
+        main_layout.addLayout(options_layout)
+
+        self.lookup_checkbox = QCheckBox("Prompt lookup")
+        self.lookup_checkbox.setStyleSheet("color: white;")
+        self.lookup_checkbox.setToolTip(
+            "Draft tokens from the selection for context actions (next model load)"
+        )
+        self.lookup_checkbox.setChecked(
+            settings.value("llmPromptLookup", False, type=bool)
+        )
+        self.lookup_checkbox.toggled.connect(
+            lambda checked: settings.setValue("llmPromptLookup", checked)
+        )
+
+        self.model_button = QPushButton("MODEL")
+        self.model_button.setToolTip("Load or switch the GGUF model")
+        self.model_button.setStyleSheet(
+            "background-color: #444444; color: white; font-weight: bold; border-radius: 5px;"
+        )
+        self.model_button.clicked.connect(self._load_model)
+
+        self.server_checkbox = QCheckBox("Server")
+        self.server_checkbox.setStyleSheet("color: white;")
+        self.server_checkbox.setToolTip(
+            "Run the model in a local server process shared by all windows (next model load)"
+        )
+        self.server_checkbox.setChecked(settings.value("llmServer", False, type=bool))
+        self.server_checkbox.toggled.connect(
+            lambda checked: settings.setValue("llmServer", checked)
+        )
+
+        model_layout = QHBoxLayout()
+        model_layout.addWidget(self.model_button)
+        model_layout.addWidget(self.mmap_checkbox)
+        model_layout.addWidget(self.mlock_checkbox)
+        model_layout.addWidget(self.lookup_checkbox)
+        model_layout.addWidget(self.server_checkbox)
+        main_layout.addLayout(model_layout)
+
+        self.chat_model = SW_ChatModel(parent=self)
+        self.chat_view = SW_ChatView()
+        self.chat_view.setModel(self.chat_model)
+
+        main_layout.addWidget(self.chat_view)
 
         container = QWidget(self.ai_widget)
         container.setLayout(main_layout)
@@ -1280,103 +2208,220 @@ class SW_Workspace(QMainWindow):
         self.ai_widget.layout().addWidget(container)
 
         self.ai_widget.setStyleSheet("background-color: transparent;")
-        self.scrollableArea.setStyleSheet("background-color:#000000; color:white;")
+        self.chat_view.setStyleSheet("background-color:#000000; color:white;")
 
     def hideAIWidget(self):
         self.ai_widget.setVisible(False)
 
     def clearMessages(self):
-        for i in range(self.messages_layout.count()):
-            widget = self.messages_layout.itemAt(i).widget()
-            if widget:
-                widget.deleteLater()
-
-    def LLMmessage(self, text, is_user=True, typing_speed=25):
-        DetectorFactory.seed = 0
-
-        language = ""
-
-        if len(text) > 30:
-            language = detect(text)
+        self.clearMessageWidgets()
+        path = self.LLMsessionPath()
+        if path and os.path.exists(path):
+            os.remove(path)
+        self.llm_session = ChatSession(self.llm_model_path)
+
+    def clearMessageWidgets(self):
+        # Pending answers would otherwise stream into removed messages
+        for request in self.llm_requests:
+            request.cancel()
+            request.token.disconnect()
+            request.completed.disconnect()
+        self.llm_requests = []
+        self.stop_button.setEnabled(self.llm_load_request is not None)
+        self.LLMupdateActions()
+        self.chat_model.clear()
+
+    def LLMsessionPath(self):
+        if not self.file_name or not self.llm_model_path:
+            return None
+        key = f"{os.path.abspath(self.file_name)}|{self.llm_model_path}"
+        return os.path.join(
+            fallbackValues["cacheDirectory"],
+            "sessions",
+            hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pkl",
+        )
 
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def LLMbatchPath(self, action):
+        # Checkpoints belong to the saved file, an untitled document cannot resume
+        if not self.file_name:
+            return None
+        key = f"{os.path.abspath(self.file_name)}|{action}"
+        return os.path.join(
+            fallbackValues["cacheDirectory"],
+            "batch",
+            hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json",
+        )
 
-        text = text.replace("\n", "<br>")
-        text = self.LLMconvertMarkdownHTML(text)
+    def LLMbatchUnits(self, action):
+        # Paragraphs for fixes; sections start at headings for summaries and fall
+        # back to paragraphs when the document has no headings
+        units = []
+        block = self.DocumentArea.document().firstBlock()
+        while block.isValid():
+            text = block.text().replace("\ufffc", "").strip()
+            if text:
+                units.append((block.blockFormat().headingLevel(), text))
+            block = block.next()
+
+        if action != "summary" or not any(level for level, _ in units):
+            return [text for _, text in units]
+
+        sections = []
+        for level, text in units:
+            if level or not sections:
+                sections.append([text])
+            else:
+                sections[-1].append(text)
+        return ["\n".join(section) for section in sections]
 
-        message_widget = QWidget()
-        message_layout = QHBoxLayout()
+    def LLMstartBatch(self, action):
+        if self.llm_model_path is None:
+            self.status_bar.showMessage("Load a model to run batch jobs.", 5000)
+            return
+        if self.batch_request is not None:
+            self.status_bar.showMessage("A batch job is already running.", 5000)
+            return
+        path = self.LLMbatchPath(action)
+        if path is None:
+            self.status_bar.showMessage("Save the document to run batch jobs.", 5000)
+            return
 
-        if language:
-            message_label_content = f"{text}<br><br>({current_time} - {language})"
-        else:
-            message_label_content = f"{text}<br><br>({current_time})"
+        job = BatchJob.load(path, action, self.llm_model_path) or BatchJob(
+            path, action, self.llm_model_path
+        )
+        job.setUnits(self.LLMbatchUnits(action))
+        job.save()
+        self.batch_job = job
+        self.LLMbatchStep()
 
-        message_label = QLabel(message_label_content)
-        message_label.setWordWrap(True)
-        message_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
-        message_label.setTextFormat(Qt.RichText)
+    def LLMresumeBatch(self):
+        if self.batch_request is not None:
+            return
+        for action in batchActions:
+            path = self.LLMbatchPath(action)
+            job = BatchJob.load(path, action, self.llm_model_path) if path else None
+            if job is not None and job.pending(1):
+                job.setUnits(self.LLMbatchUnits(action))
+                self.batch_job = job
+                done, total = job.progress()
+                self.status_bar.showMessage(
+                    f"Resuming {batchActions[action].lower()} at {done}/{total}", 5000
+                )
+                self.LLMbatchStep()
+                return
 
-        max_width = 400
-        message_label.setMaximumWidth(max_width)
+    def LLMbatchStep(self):
+        if not self.batch_job.pending(1):
+            self.LLMbatchFinished()
+            return
 
-        if is_user:
-            message_label.setStyleSheet(
-                "background-color: #d1e7ff; color: #000; border-radius: 15px; padding: 10px; margin: 5px;"
-            )
-            message_layout.addWidget(message_label, alignment=Qt.AlignRight)
-        else:
-            message_label.setStyleSheet(
-                "background-color: #f1f1f1; color: #000; border-radius: 15px; padding: 10px; margin: 5px;"
+        request = InferenceRequest(
+            priority=InferenceEngine.priorityBackground,
+            task=partial(self.inference_engine.runBatch, self.batch_job),
+            max_tokens=256,
+        )
+        request.completed.connect(partial(self.LLMbatchProgress, request))
+        self.batch_request = request
+        self.inference_engine.submit(request)
+
+    def LLMbatchProgress(self, request, response):
+        self.batch_request = None
+        done, total = self.batch_job.progress()
+        if response:
+            self.status_bar.showMessage(response, 5000)
+            return
+        if request.isCancelled():
+            self.status_bar.showMessage(
+                f"Batch stopped at {done}/{total}, it resumes from there.", 5000
             )
-            message_layout.addWidget(message_label, alignment=Qt.AlignLeft)
-
-        message_widget.setLayout(message_layout)
+            return
 
-        self.messages_layout.addWidget(message_widget)
+        self.status_bar.showMessage(
+            f"{batchActions[self.batch_job.action]}: {done}/{total}", 5000
+        )
+        if self.batch_review is not None and self.batch_review.job is self.batch_job:
+            self.batch_review.refresh()
+        self.LLMrestartIdleTimer()
+        QTimer.singleShot(0, self.LLMbatchStep)
 
-        if not is_user:
-            self.LLMdynamicMessage(
-                message_label, text, typing_speed * self.adaptiveResponse
-            )
+    def LLMbatchFinished(self):
+        count = len(self.batch_job.annotations())
+        self.status_bar.showMessage(
+            f"{batchActions[self.batch_job.action]} finished, "
+            f"{count} annotations to review.",
+            5000,
+        )
+        if count:
+            self.LLMreviewBatch()
 
-        if is_user:
-            self.full_text = ""
+    def LLMstopBatch(self):
+        if self.batch_request is not None:
+            self.batch_request.cancel()
 
-    def LLMdynamicMessage(self, message_label, text, typing_speed):
-        words = text.split()
+    def LLMreviewBatch(self):
+        if self.batch_job is None:
+            self.status_bar.showMessage("No batch job to review.", 5000)
+            return
+        if self.batch_review is None or self.batch_review.job is not self.batch_job:
+            self.batch_review = SW_BatchReview(self.batch_job, self.DocumentArea, self)
+        self.batch_review.refresh()
+        self.batch_review.show()
+        self.batch_review.raise_()
+
+    def LLMsaveSession(self):
+        path = self.LLMsessionPath()
+        session = self.llm_session
+        if (
+            not path
+            or not session.messages
+            or not settings.value("llmPersistSessions", False, type=bool)
+        ):
+            return
 
-        if not hasattr(self, "full_text"):
-            self.full_text = ""
+        if self.inference_engine.isRunning():
+            # The KV state has to be read on the thread that owns the model
+            self.inference_engine.submit(
+                InferenceRequest(
+                    priority=InferenceEngine.priorityInteractive,
+                    task=lambda llm: self.inference_engine.persistSession(
+                        session, path
+                    ),
+                    needs_model=False,
+                )
+            )
+        else:
+            self.inference_engine.persistSession(session, path)
 
-        word_index = 0
+    def LLMrestoreSession(self):
+        self.clearMessageWidgets()
+        self.llm_session = ChatSession(self.llm_model_path)
 
-        def type_next_word():
-            nonlocal word_index
-            if word_index < len(words):
-                self.full_text += words[word_index] + " "
-                message_label.setText(self.full_text)
-                word_index += 1
-            else:
-                self.LLMmessageDatetime(message_label)
-                self.typing_timer.stop()
+        path = self.LLMsessionPath()
+        if not path or not settings.value("llmPersistSessions", False, type=bool):
+            return
 
-        self.typing_timer = QTimer(self)
-        self.typing_timer.timeout.connect(type_next_word)
-        self.typing_timer.start(typing_speed)
+        session = ChatSession.load(path, self.llm_model_path)
+        if session is None:
+            return
 
-    def LLMmessageDatetime(self, message_label):
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        language = (
-            detect(message_label.text()) if len(message_label.text()) > 30 else ""
-        )
+        self.llm_session = session
+        for message in session.messages:
+            self.chat_model.addMessage(
+                message["content"],
+                message["role"] == "user",
+                markdownToHtml(message["content"]),
+            )
 
-        if language:
-            new_text = f"{message_label.text()}<br><br>({current_time} - {language})"
+    def LLMmessage(self, text, is_user=True, stream=False):
+        if stream:
+            message_id = self.chat_model.addMessage(text, is_user)
         else:
-            new_text = f"{message_label.text()}<br><br>({current_time})"
-
-        message_label.setText(new_text)
+            message_id = self.chat_model.addMessage(
+                text, is_user, markdownToHtml(text)
+            )
+            self.chat_model.setFooter(message_id)
+        QTimer.singleShot(0, self.LLMscrollToBottom)
+        return message_id
 
     def LLMpredict(self):
         prompt = self.input_text.toPlainText().strip()
@@ -1389,18 +2434,251 @@ class SW_Workspace(QMainWindow):
         self.predict_button.setText("...")
         self.predict_button.setEnabled(False)
 
-        self.llm_thread = SW_LLMThread(prompt, self.llm)
-        self.llm_thread.result.connect(self.LLMhandleResponse)
-        self.llm_thread.start()
+        task = None
+        if (
+            self.document_checkbox.isChecked()
+            and self.inference_engine.isLocal()
+            and not self.retrieval_index.isEmpty()
+        ):
+            # Answer from the most similar paragraphs instead of the whole document
+            task = partial(
+                self.inference_engine.answerFromDocument, self.retrieval_index, prompt
+            )
+
+        self.LLMstartResponse(
+            [{"role": "user", "content": prompt}], self.llm_session, task=task
+        )
+
+    def LLMscheduleIndex(self):
+        # Indexing alone does not bring back a model unloaded for idleness
+        if (
+            self.llm_model_path is not None
+            and self.inference_engine.isLocal()
+            and self.document_checkbox.isChecked()
+        ):
+            self.index_timer.start()
+
+    def LLMindexDocument(self):
+        if (
+            self.llm_model_path is None
+            or not self.inference_engine.isLocal()
+            or self.llm_index_request is not None
+            or not self.document_checkbox.isChecked()
+        ):
+            return
+
+        self.retrieval_index.update(self.DocumentArea.toPlainText().split("\n"))
+        if not self.retrieval_index.pending(1):
+            return
+
+        request = InferenceRequest(
+            priority=InferenceEngine.priorityBackground,
+            task=partial(self.inference_engine.indexDocument, self.retrieval_index),
+        )
+        request.completed.connect(self.LLMdocumentIndexed)
+        self.llm_index_request = request
+        self.inference_engine.submit(request)
+
+    def LLMdocumentIndexed(self, response):
+        self.llm_index_request = None
+        if response:
+            self.status_bar.showMessage(response, 5000)
+        elif self.retrieval_index.pending(1):
+            # One batch per request, interactive requests run in between
+            QTimer.singleShot(0, self.LLMindexDocument)
+
+    def LLMscheduleAutocomplete(self):
+        self.LLMcancelAutocomplete()
+        if self.autocomplete_checkbox.isChecked() and self.llm_model_path is not None:
+            self.completion_timer.start()
+
+    def LLMcancelAutocomplete(self):
+        # Any keystroke or cursor move makes the pending suggestion stale
+        if self.completion_request is not None:
+            self.completion_request.cancel()
+            self.completion_request = None
+        self.DocumentArea.setGhostText("")
+
+    def LLMautocomplete(self):
+        area = self.DocumentArea
+        cursor = area.textCursor()
+        # Never queue behind an answer or bring back a model unloaded while idle
+        if (
+            not self.autocomplete_checkbox.isChecked()
+            or self.llm_model_path is None
+            or self.llm_requests
+            or self.llm_load_request is not None
+            or not self.inference_engine.isResident()
+            or area.isReadOnly()
+            or not area.hasFocus()
+            or cursor.hasSelection()
+            or not cursor.atBlockEnd()
+        ):
+            return
+
+        # The window start moves in steps, so successive prefixes share their
+        # beginning and the KV cache of the previous suggestion is reused
+        window, step = 1536, 256
+        position = cursor.position()
+        selector = QTextCursor(area.document())
+        selector.setPosition(max(0, (position - window) // step * step))
+        selector.setPosition(position, QTextCursor.KeepAnchor)
+        prefix = selector.selectedText().replace("\u2029", "\n").replace("\ufffc", "")
+        if not prefix.strip():
+            return
 
-    def LLMhandleResponse(self, response):
-        self.LLMmessage(response, is_user=False)
+        self.LLMcancelAutocomplete()
+        request = InferenceRequest(
+            priority=InferenceEngine.priorityInteractive,
+            task=partial(self.inference_engine.complete, prefix),
+            max_tokens=16,
+            temperature=0.2,
+            stop=["\n"],
+        )
+        request.token.connect(partial(self.LLMautocompleteToken, request))
+        request.completed.connect(lambda _: self.LLMrestartIdleTimer())
+        self.completion_request = request
+        self.inference_engine.submit(request)
+
+    def LLMautocompleteToken(self, request, text):
+        if request is self.completion_request:
+            area = self.DocumentArea
+            area.setGhostText((area.ghost_text + text).lstrip("\n"))
+
+    def LLMstartResponse(
+        self, messages, session=None, cacheable=False, task=None, speculative=False
+    ):
+        message_id = self.LLMmessage("", is_user=False, stream=True)
+
+        params = {"seed": 0} if cacheable else {}
+        request = InferenceRequest(
+            messages,
+            InferenceEngine.priorityInteractive,
+            session=session,
+            task=task,
+            cacheable=cacheable,
+            speculative=speculative,
+            **params,
+        )
+        renderer = MarkdownStream()
+        request.token.connect(
+            lambda text: self.chat_model.appendHtml(
+                message_id, renderer.feed(text), text, renderer.pending()
+            )
+        )
+        request.token.connect(lambda _: QTimer.singleShot(0, self.LLMscrollToBottom))
+        request.completed.connect(
+            partial(self.LLMhandleResponse, message_id, request, renderer)
+        )
+
+        self.llm_requests.append(request)
+        self.stop_button.setEnabled(True)
+        self.LLMrestartIdleTimer()
+        self.inference_engine.submit(request)
+
+    def LLMstop(self):
+        for request in self.llm_requests:
+            request.cancel()
+        if self.llm_load_request is not None:
+            self.llm_load_request.cancel()
+
+    def LLMscrollToBottom(self):
+        self.chat_view.scrollToBottom()
+
+    def LLMhandleResponse(self, message_id, request, renderer, response):
+        if request in self.llm_requests:
+            self.llm_requests.remove(request)
+        self.stop_button.setEnabled(
+            bool(self.llm_requests) or self.llm_load_request is not None
+        )
+
+        if request.isCancelled():
+            response += "\n\n(stopped)"
+
+        row = self.chat_model.row(message_id)
+        if row is not None and self.chat_model.messages[row]["text"] == response:
+            # Everything streamed already, only the unfinished line is left to render
+            self.chat_model.appendHtml(message_id, renderer.finish())
+        else:
+            # Cached, summarized or stopped answers differ from what was streamed
+            self.chat_model.setMessage(message_id, markdownToHtml(response), response)
+        note = "cached" if request.cached else ""
+        if request.decoding is not None:
+            note = f"{request.decoding['tokens_per_second']:.1f} tok/s"
+            if request.decoding["mode"] == "lookup":
+                note += f", lookup {request.decoding['acceptance']:.0%} accepted"
+        if request.metrics is not None and self.metrics_checkbox.isChecked():
+            note = self.LLMformatMetrics(request.metrics, request.decoding)
+        if request.trimmed:
+            note = ", ".join(part for part in (note, "prompt trimmed to fit") if part)
+        self.chat_model.setFooter(message_id, note)
         self.input_text.clear()
-        self.predict_button.setText("->")
-        self.predict_button.setEnabled(True)
+        self.LLMupdateActions()
+        self.LLMrestartIdleTimer()
+
+        lookup_rate = self.inference_engine.decodingRate("lookup")
+        standard_rate = self.inference_engine.decodingRate("standard")
+        if request.speculative and lookup_rate and standard_rate:
+            self.status_bar.showMessage(
+                f"Prompt lookup {lookup_rate:.1f} tok/s, "
+                f"standard {standard_rate:.1f} tok/s",
+                5000,
+            )
+
+    def LLMformatMetrics(self, metrics, decoding=None):
+        parts = []
+        if metrics["ttft_ms"] is not None:
+            parts.append(f"TTFT {metrics['ttft_ms']:.0f} ms")
+        if metrics["prompt_tokens_per_second"] is not None:
+            parts.append(
+                f"prompt {metrics['prompt_tokens']} @ "
+                f"{metrics['prompt_tokens_per_second']:.1f} tok/s"
+            )
+        if metrics["generation_tokens_per_second"] is not None:
+            parts.append(f"gen {metrics['generation_tokens_per_second']:.1f} tok/s")
+        if metrics["context_fill"] is not None:
+            parts.append(f"ctx {metrics['context_fill']:.0%}")
+        parts.append(f"{metrics['peak_rss_mb']:.0f} MB")
+        if decoding is not None and decoding["mode"] == "lookup":
+            parts.append(f"lookup {decoding['acceptance']:.0%}")
+        return ", ".join(parts)
+
+    def LLMexportMetrics(self):
+        file_name, _ = QFileDialog.getSaveFileName(
+            self,
+            "Export AI metrics",
+            os.path.join(self.directory, "solidwriting_ai_metrics.json"),
+            "JSON (*.json)",
+        )
+        if not file_name:
+            return
+        with open(file_name, "w", encoding="utf-8") as file:
+            json.dump(list(self.inference_engine.metrics_log), file, indent=2)
+        self.status_bar.showMessage(file_name, 2500)
+
+    def LLMselectedText(self):
+        return (
+            self.DocumentArea.textCursor().selectedText().replace("\u2029", "\n").strip()
+        )
+
+    def LLMcountSelection(self):
+        text = self.LLMselectedText()
+        if (
+            not text
+            or not self.inference_engine.isResident()
+            or self.inference_engine.cachedTokenCount(text) is not None
+        ):
+            return
+        self.inference_engine.submit(
+            InferenceRequest(
+                priority=InferenceEngine.priorityInteractive,
+                task=partial(self.inference_engine.countTask, text),
+                needs_model=False,
+            )
+        )
 
     def LLMcontextPredict(self, action_type):
-        selected_text = self.DocumentArea.textCursor().selectedText().strip()
+        selected_text = self.LLMselectedText()
 
         if action_type:
             prompt = f"{action_type}: {selected_text}"
@@ -1417,56 +2695,17 @@ class SW_Workspace(QMainWindow):
             self.LLMmessage("No text selected.", is_user=False)
             return
 
-        self.llm_thread = SW_LLMThread(prompt, self.llm)
-        self.llm_thread.result.connect(self.LLMhandleResponse)
-        self.llm_thread.start()
-
-    def LLMprompt(self, prompt):
-        if prompt:
-            response = self.LLMresponse(prompt)
-            self.LLMmessage(response, is_user=False)
-            self.input_text.clear()
-        else:
-            self.LLMmessage("Please enter a question.", is_user=False)
-
-        self.predict_button.setText("->")
-        self.predict_button.setEnabled(True)
-
-    def LLMresponse(self, prompt):
-        try:
-            response = self.llm.create_chat_completion(
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return response["choices"][0]["message"]["content"]
-        except Exception as e:
-            return str(e)
-
-    def LLMconvertMarkdownHTML(self, markdown_text):
-        markdown_text = self.LLMconvertCodeHTML(markdown_text)
-        markdown_text = self.convertBoldItalic(markdown_text)
-        return markdown_text
-
-    def convertBoldItalic(self, text):
-        text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text)  # **bold**
-        text = re.sub(r"__(.*?)__", r"<b>\1</b>", text)  # __bold__
-        text = re.sub(r"\*(.*?)\*", r"<i>\1</i>", text)  # *italic*
-        text = re.sub(r"_(.*?)_", r"<i>\1</i>", text)  # _italic_
-        return text
-
-    def LLMconvertCodeHTML(self, text):
-        def replace_code_block(match):
-            code = match.group(1).strip()
-            return f"<pre><code>{self.LLMescapeHTML(code)}</code></pre>"
-
-        return re.sub(r"```(.*?)```", replace_code_block, text, flags=re.DOTALL)
-
-    def LLMescapeHTML(self, text):
-        return (
-            text.replace("&", "&amp;")
-            .replace("<", "&lt;")
-            .replace(">", "&gt;")
-            .replace('"', "&quot;")
-            .replace("'", "&#039;")
+        task = None
+        if action_type == "summary":
+            # Selections larger than the context window are summarized in parts
+            task = partial(self.inference_engine.summarize, selected_text)
+
+        # Rewrites and explanations repeat the selection, drafts from it get accepted
+        self.LLMstartResponse(
+            contextMessages(selected_text, action_type),
+            cacheable=True,
+            task=task,
+            speculative=action_type != "summary",
         )
 
     def toolbarLabel(self, toolbar, text):
@@ -1878,6 +3117,8 @@ class SW_Workspace(QMainWindow):
 
         zoom_level = value / 100.0
         self.graphicsView.setTransform(QTransform().scale(zoom_level, zoom_level))
+        if hasattr(self, "image_refresh_timer"):
+            self.image_refresh_timer.start()
 
     def addTable(self):
         templates = [
@@ -2042,18 +3283,14 @@ class SW_Workspace(QMainWindow):
         settings.setValue("adaptiveResponse", self.adaptiveResponse)
         settings.sync()
 
-    def detectEncoding(file_path):
-        with open(file_path, "rb") as file:
-            detector = chardet.universaldetector.UniversalDetector()
-            for line in file:
-                detector.feed(line)
-                if detector.done:
-                    break
-            detector.close()
-        return detector.result["encoding"]
+    def forgetSavedRevisions(self):
+        # Revisions restart with a new document, cached ones could skip a real save
+        self.save_hashes.clear()
+        self.state_revision = None
 
     def resetDocumentArea(self):
         self.DocumentArea.clear()
+        self.forgetSavedRevisions()
         self.DocumentArea.setFontFamily(fallbackValues["fontFamily"])
         self.DocumentArea.setFontPointSize(fallbackValues["fontSize"])
         self.DocumentArea.setFontWeight(75 if fallbackValues["bold"] else 50)
@@ -2067,11 +3304,13 @@ class SW_Workspace(QMainWindow):
 
     def newFile(self):
         if self.is_saved:
+            self.LLMsaveSession()
             self.resetDocumentArea()
             self.directory = self.default_directory
             self.file_name = None
             self.is_saved = False
             self.updateTitle()
+            self.LLMrestoreSession()
         else:
             lang = settings.value("appLanguage", "1252")
             reply = QMessageBox.question(
@@ -2083,11 +3322,13 @@ class SW_Workspace(QMainWindow):
             )
 
             if reply == QMessageBox.Yes:
+                self.LLMsaveSession()
                 self.resetDocumentArea()
                 self.directory = self.default_directory
                 self.file_name = None
                 self.is_saved = False
                 self.updateTitle()
+                self.LLMrestoreSession()
 
     def openFile(self, file_to_open=None):
         lang = settings.value("appLanguage", "1252")
@@ -2106,34 +3347,24 @@ class SW_Workspace(QMainWindow):
             )
 
         if selected_file:
+            self.LLMsaveSession()
             self.file_name = selected_file
+            self.forgetSavedRevisions()
             try:
-                automaticEncoding = SW_Workspace.detectEncoding(self.file_name)
+                kind, content = self.document_engine.read(self.file_name)
+                if kind == "html":
+                    self.DocumentArea.setHtml(content)
+                elif kind == "markdown":
+                    self.DocumentArea.setMarkdown(content)
+                else:
+                    self.DocumentArea.setPlainText(content)
             except Exception as e:
-                automaticEncoding = "utf-8"
-
-            if self.file_name.endswith(".docx"):
-                with open(self.file_name, "rb") as file:
-                    try:
-                        conversionLayer = mammoth.convert_to_html(file)
-                        self.DocumentArea.setHtml(conversionLayer.value)
-                    except Exception as e:
-                        QMessageBox.warning(self, None, "Conversion failed.")
-            else:
-                with open(self.file_name, "r", encoding=automaticEncoding) as file:
-                    if self.file_name.endswith((".swdoc", ".rsdoc")):
-                        self.DocumentArea.setHtml(file.read())
-                    elif self.file_name.endswith((".swdoc64")):
-                        encryption = CryptoEngine("SolidWriting")
-                        self.DocumentArea.setHtml(encryption.b64_decrypt(file.read()))
-                    elif self.file_name.endswith((".md")):
-                        self.DocumentArea.setMarkdown(file.read())
-                    else:
-                        self.DocumentArea.setPlainText(file.read())
+                QMessageBox.warning(self, None, "Conversion failed.")
 
             self.directory = os.path.dirname(self.file_name)
             self.is_saved = True
             self.updateTitle()
+            self.LLMrestoreSession()
 
     def saveFile(self):
         if self.is_saved == False:
@@ -2165,26 +3396,33 @@ class SW_Workspace(QMainWindow):
     def saveProcess(self):
         if not self.file_name:
             self.saveAs()
-        else:
-            try:
-                automaticEncoding = SW_Workspace.detectEncoding(self.file_name)
-            except Exception as e:
-                automaticEncoding = "utf-8"
-            if self.file_name.lower().endswith(".docx"):
-                pass
-            else:
-                with open(self.file_name, "w", encoding=automaticEncoding) as file:
-                    if self.file_name.lower().endswith((".swdoc")):
-                        file.write(self.DocumentArea.toHtml())
-                    elif self.file_name.lower().endswith((".swdoc64")):
-                        encryption = CryptoEngine("SolidWriting")
-                        file.write(encryption.b64_encrypt(self.DocumentArea.toHtml()))
-                    elif self.file_name.lower().endswith((".md")):
-                        file.write(self.DocumentArea.toMarkdown())
-                    else:
-                        document = QTextDocument()
-                        document.setPlainText(self.DocumentArea.toPlainText())
-                        file.write(document.toPlainText())
+        elif not self.file_name.lower().endswith(".docx"):
+            # (file, format) -> (document revision, content hash, file mtime)
+            key = (self.file_name, os.path.splitext(self.file_name)[1].lower())
+            revision = self.DocumentArea.document().revision()
+            cached = self.save_hashes.get(key)
+            mtime = (
+                os.path.getmtime(self.file_name)
+                if os.path.exists(self.file_name)
+                else None
+            )
+
+            if cached and cached[0] == revision and cached[2] == mtime:
+                self.status_bar.showMessage("Saved.", 2000)
+                self.is_saved = True
+                self.updateTitle()
+                return
+
+            content = self.document_engine.serialize(
+                self.DocumentArea.document(), self.file_name
+            )
+            digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+            if not (cached and cached[1] == digest and cached[2] == mtime):
+                self.document_engine.write(self.file_name, content)
+                mtime = os.path.getmtime(self.file_name)
+
+            self.save_hashes[key] = (revision, digest, mtime)
 
         self.status_bar.showMessage("Saved.", 2000)
         self.is_saved = True
@@ -2221,8 +3459,26 @@ class SW_Workspace(QMainWindow):
             with open(selected_file, "rb") as file:
                 data = file.read()
                 data = base64.b64encode(data).decode("utf-8")
-                img_tag = f'<img src="data:{mime_type};base64,{data}"/>'
-                self.DocumentArea.insertHtml(img_tag)
+                url = f"data:{mime_type};base64,{data}"
+
+            # The original stays in the HTML for export, only the scaled copy is painted
+            source = self.image_engine.source(url)
+            if source is None:
+                self.DocumentArea.insertHtml(f'<img src="{url}"/>')
+                return
+
+            logical_size = self.image_engine.displaySize(
+                source[1], self.DocumentArea.imageMaxWidth()
+            )
+            self.DocumentArea.registerImage(url, logical_size)
+            self.DocumentArea.insertHtml(
+                f'<img src="{url}" width="{logical_size.width()}" height="{logical_size.height()}"/>'
+            )
+
+    def refreshImageResources(self):
+        self.DocumentArea.setImageScale(
+            self.graphicsView.transform().m11() * self.devicePixelRatioF()
+        )
 
     def viewAbout(self):
         self.about_window = SW_About()
@@ -2491,6 +3747,10 @@ class SW_Workspace(QMainWindow):
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] in headlessCommands:
+        sys.exit(runHeadless(sys.argv[1:]))
+
     if getattr(sys, "frozen", False):
         applicationPath = sys._MEIPASS
     elif __file__:
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import threading
+
+batchActions = {
+    "summary": "Summarize each section",
+    "suggestions": "Suggest fixes per paragraph",
+}
+
+
+class BatchJob:
+    # Results are keyed by the digest of their text and written after every
+    # unit, so a restarted job skips finished units and edits elsewhere in the
+    # document do not invalidate them
+    def __init__(self, path, action, model_path):
+        self.path = path
+        self.action = action
+        self.model_path = model_path
+        self.units = []
+        self.results = {}
+        self.dismissed = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def load(path, action, model_path):
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if data.get("action") != action or data.get("model_path") != model_path:
+            return None
+        job = BatchJob(path, action, model_path)
+        job.units = data.get("units", [])
+        job.results = data.get("results", {})
+        job.dismissed = set(data.get("dismissed", []))
+        return job
+
+    def save(self):
+        # The worker records results while the review dialog dismisses them
+        with self.lock:
+            data = {
+                "action": self.action,
+                "model_path": self.model_path,
+                "units": self.units,
+                "results": self.results,
+                "dismissed": sorted(self.dismissed),
+            }
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = self.path + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(data, file, ensure_ascii=False)
+            os.replace(temporary, self.path)
+
+    def setUnits(self, units):
+        with self.lock:
+            self.units = [unit for unit in dict.fromkeys(units) if unit.strip()]
+            digests = {self.digest(unit) for unit in self.units}
+            # Results of removed or edited units are dropped
+            self.results = {
+                key: value for key, value in self.results.items() if key in digests
+            }
+            self.dismissed &= digests
+
+    def pending(self, limit=None):
+        with self.lock:
+            texts = [unit for unit in self.units if self.digest(unit) not in self.results]
+        return texts[:limit] if limit else texts
+
+    def record(self, text, result):
+        with self.lock:
+            self.results[self.digest(text)] = result
+        self.save()
+
+    def dismiss(self, text):
+        with self.lock:
+            self.dismissed.add(self.digest(text))
+        self.save()
+
+    def progress(self):
+        with self.lock:
+            return len(self.results), len(self.units)
+
+    def annotations(self):
+        # (unit, result) pairs still waiting for review, in document order
+        with self.lock:
+            return [
+                (unit, self.results[key])
+                for unit, key in ((unit, self.digest(unit)) for unit in self.units)
+                if key in self.results and key not in self.dismissed
+            ]
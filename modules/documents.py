@@ -0,0 +1,66 @@
+import chardet
+import mammoth
+from PySide6.QtGui import QTextDocument
+
+from modules.crypto import CryptoEngine
+
+
+class DocumentEngine:
+    readExtensions = (".swdoc", ".swdoc64", ".rsdoc", ".docx", ".txt", ".ini", ".md")
+    writeExtensions = (".swdoc", ".swdoc64", ".txt", ".ini", ".md")
+
+    def detectEncoding(self, file_path: str) -> str:
+        try:
+            with open(file_path, "rb") as file:
+                detector = chardet.universaldetector.UniversalDetector()
+                for line in file:
+                    detector.feed(line)
+                    if detector.done:
+                        break
+                detector.close()
+            return detector.result["encoding"] or "utf-8"
+        except Exception:
+            return "utf-8"
+
+    def read(self, file_name: str):
+        # Returns (kind, content) where kind is "html", "markdown" or "plain"
+        if file_name.lower().endswith(".docx"):
+            with open(file_name, "rb") as file:
+                return "html", mammoth.convert_to_html(file).value
+
+        with open(file_name, "r", encoding=self.detectEncoding(file_name)) as file:
+            content = file.read()
+
+        if file_name.lower().endswith((".swdoc", ".rsdoc")):
+            return "html", content
+        elif file_name.lower().endswith(".swdoc64"):
+            encryption = CryptoEngine("SolidWriting")
+            return "html", encryption.b64_decrypt(content)
+        elif file_name.lower().endswith(".md"):
+            return "markdown", content
+        return "plain", content
+
+    def load(self, file_name: str, document: QTextDocument):
+        kind, content = self.read(file_name)
+        if kind == "html":
+            document.setHtml(content)
+        elif kind == "markdown":
+            document.setMarkdown(content)
+        else:
+            document.setPlainText(content)
+
+    def serialize(self, document: QTextDocument, file_name: str) -> str:
+        if file_name.lower().endswith(".swdoc"):
+            return document.toHtml()
+        elif file_name.lower().endswith(".swdoc64"):
+            encryption = CryptoEngine("SolidWriting")
+            return encryption.b64_encrypt(document.toHtml())
+        elif file_name.lower().endswith(".md"):
+            return document.toMarkdown()
+        return document.toPlainText()
+
+    def write(self, file_name: str, content: str, encoding: str = None):
+        if encoding is None:
+            encoding = self.detectEncoding(file_name)
+        with open(file_name, "w", encoding=encoding) as file:
+            file.write(content)
@@ -1,4 +1,6 @@
-from PySide6.QtCore import Qt
+import os
+
+from PySide6.QtCore import QStandardPaths, Qt
 
 fallbackValues = {
     "icon": "solidwriting_icon.ico",
@@ -22,6 +24,10 @@ fallbackValues = {
     "readFilter": "General File (*.swdoc *.swdoc64 *.docx *.rsdoc);;Text (*.txt);;Key-Value (*.ini);;Markdown (*.md)",
     "writeFilter": "SolidWriting Document (*.swdoc);;SolidWriting Base64 (*.swdoc64);;Text (*.txt);;Key-Value (*.ini);;Markdown (*.md)",
     "mediaFilter": "General (*.png *.jpg *.jpeg *.bmp)",
+    "cacheDirectory": os.path.join(
+        QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation),
+        "SolidWriting",
+    ),
 }
 
 # Locale ID (LCID)
@@ -0,0 +1,74 @@
+import ctypes.util
+import glob
+import importlib.util
+import os
+import platform
+import sys
+from functools import lru_cache
+
+import llama_cpp.llama_cpp as llama_lib
+
+# backend: (markers in llama's system info or library names, device files, libraries)
+acceleratorBackends = {
+    "cuda": (("CUDA",), ("/dev/nvidia0", "/dev/nvidiactl"), ("cuda", "nvcuda")),
+    "rocm": (("HIP", "ROCM"), ("/dev/kfd",), ("amdhip64",)),
+    "mps": (("METAL",), (), ()),
+    "vulkan": (("VULKAN",), (), ("vulkan", "vulkan-1")),
+}
+
+
+def compiledBackends():
+    # Split builds ship ggml-<backend> libraries, monolithic ones list them in system info
+    evidence = [llama_lib.llama_print_system_info().decode("utf-8", "replace")]
+    base_path = getattr(llama_lib, "_base_path", None)
+    if base_path is not None:
+        evidence += [
+            os.path.basename(path)
+            for path in glob.glob(os.path.join(str(base_path), "*ggml*"))
+        ]
+    evidence = " ".join(evidence).upper()
+    return [
+        name
+        for name, (markers, _, _) in acceleratorBackends.items()
+        if any(marker in evidence for marker in markers)
+    ]
+
+
+def deviceAvailable(backend):
+    _, devices, libraries = acceleratorBackends[backend]
+    if backend == "mps":
+        return sys.platform == "darwin" and platform.machine() == "arm64"
+    if any(os.path.exists(device) for device in devices):
+        return True
+    # find_library may spawn ldconfig, so it is only the fallback
+    return any(ctypes.util.find_library(library) for library in libraries)
+
+
+def torchAccelerator():
+    import torch
+
+    if torch.cuda.is_available():
+        return "rocm" if getattr(torch.version, "hip", None) else "cuda"
+    elif torch.is_vulkan_available():
+        return "vulkan"
+    elif torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+@lru_cache(maxsize=None)
+def acceleratorBackend(use_torch=False):
+    if use_torch and importlib.util.find_spec("torch") is not None:
+        return torchAccelerator()
+
+    # A device llama was not built for cannot take offloaded layers anyway.
+    # The library layout is llama-cpp-python internals, any surprise means CPU.
+    try:
+        if not llama_lib.llama_supports_gpu_offload():
+            return "cpu"
+        for backend in compiledBackends():
+            if deviceAvailable(backend):
+                return backend
+    except Exception:
+        pass
+    return "cpu"
@@ -0,0 +1,365 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PySide6.QtGui import QGuiApplication, QTextDocument
+
+from modules.documents import DocumentEngine
+from modules.globals import fallbackValues
+from modules.statistics import StatisticsEngine
+
+headlessCommands = ("convert", "stats", "serve")
+statisticsFields = (
+    "characters",
+    "words",
+    "lines",
+    "avg_word_length",
+    "avg_line_length",
+    "uppercase",
+    "lowercase",
+    "language",
+)
+# Entries are kept in least recently used order, the oldest are dropped first
+statisticsCacheEntries = 20000
+
+workerApplication = None
+
+
+def initWorker():
+    global workerApplication
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    workerApplication = QGuiApplication.instance() or QGuiApplication([])
+
+
+def collectFiles(paths, extensions):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(extensions):
+                        files.append((os.path.join(root, name), path))
+        elif os.path.isfile(path) and path.lower().endswith(extensions):
+            files.append((path, os.path.dirname(path)))
+    return files
+
+
+def convertTarget(source, base, extension, output=None):
+    stem = os.path.splitext(source)[0] + "." + extension
+    if output is None:
+        return stem
+    return os.path.join(output, os.path.relpath(stem, base))
+
+
+def convertFile(source, target):
+    started = time.perf_counter()
+    try:
+        engine = DocumentEngine()
+        document = QTextDocument()
+        engine.load(source, document)
+        content = engine.serialize(document, target)
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        # A source rewritten into itself must never be left half written
+        temporary = target + ".tmp"
+        engine.write(temporary, content, engine.detectEncoding(target))
+        os.replace(temporary, target)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "source": source,
+        "target": target,
+        "seconds": time.perf_counter() - started,
+        "error": error,
+    }
+
+
+def runConvert(args):
+    files = collectFiles(args.paths, DocumentEngine.readExtensions)
+    if not files:
+        print("No documents found.", file=sys.stderr)
+        return 1
+
+    started = time.perf_counter()
+    failures = 0
+    unchanged = 0
+
+    # Two sources writing one target would race, and a target that is another
+    # source would be overwritten while a worker still reads it. A source that
+    # is its own target is read whole before the atomic write, so it is safe.
+    targets = {}
+    for source, base in files:
+        target = convertTarget(source, base, args.to, args.output)
+        targets.setdefault(os.path.normcase(os.path.abspath(target)), []).append(
+            (source, target)
+        )
+    sources = {os.path.normcase(os.path.abspath(source)) for source, _ in files}
+
+    jobs = []
+    for key, group in targets.items():
+        source, _ = group[0]
+        if len(group) > 1:
+            error = "target shared with " + ", ".join(source for source, _ in group)
+        elif key in sources and key != os.path.normcase(os.path.abspath(source)):
+            error = "target is a source document"
+        else:
+            jobs.append(group[0])
+            continue
+        for source, target in group:
+            failures += 1
+            print(f"SKIP {0.0:8.3f}s  {source} -> {target}  {error}", file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=initWorker) as executor:
+        futures = {
+            executor.submit(convertFile, source, target): source
+            for source, target in jobs
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    "source": futures[future],
+                    "target": None,
+                    "seconds": 0.0,
+                    "error": f"{type(e).__name__}: {e}",
+                }
+
+            if result["error"]:
+                failures += 1
+                print(
+                    f"FAIL {result['seconds']:8.3f}s  {result['source']}  {result['error']}",
+                    file=sys.stderr,
+                )
+            elif os.path.normcase(os.path.abspath(result["source"])) == os.path.normcase(
+                os.path.abspath(result["target"])
+            ):
+                unchanged += 1
+                print(
+                    f"SAME {result['seconds']:8.3f}s  {result['source']}  already in target format"
+                )
+            else:
+                print(
+                    f"OK   {result['seconds']:8.3f}s  {result['source']} -> {result['target']}"
+                )
+
+    print(
+        f"{len(files) - failures - unchanged}/{len(files)} converted, "
+        f"{unchanged} already in target format, {failures} failed "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    return 1 if failures else 0
+
+
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hashFile(source):
+    started = time.perf_counter()
+    try:
+        digest = fileHash(source)
+        error = None
+    except OSError as e:
+        digest = None
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "source": source,
+        "hash": digest,
+        "seconds": time.perf_counter() - started,
+        "error": error,
+    }
+
+
+def statisticsFile(source):
+    started = time.perf_counter()
+    try:
+        document = QTextDocument()
+        DocumentEngine().load(source, document)
+        statistics = StatisticsEngine().compute(document.toPlainText())
+        error = None
+    except Exception as e:
+        statistics = None
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "source": source,
+        "seconds": time.perf_counter() - started,
+        "statistics": statistics,
+        "error": error,
+    }
+
+
+def loadStatisticsCache(path):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def saveStatisticsCache(path, cache):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        json.dump(cache, file)
+    os.replace(temporary, path)
+
+
+def runStatistics(args):
+    files = collectFiles(args.paths, DocumentEngine.readExtensions)
+    if not files:
+        print("No documents found.", file=sys.stderr)
+        return 1
+
+    cache = {} if args.no_cache else loadStatisticsCache(args.cache)
+    fields = ("path", "hash", "cached", "seconds", "error") + statisticsFields
+
+    writer = None
+    if args.format == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+        writer.writeheader()
+
+    def emit(path, digest, cached, seconds, statistics, error):
+        row = {
+            "path": path,
+            "hash": digest,
+            "cached": cached,
+            "seconds": round(seconds, 4),
+            "error": error,
+        }
+        row.update(statistics or dict.fromkeys(statisticsFields))
+        if writer:
+            writer.writerow(row)
+        else:
+            print(json.dumps(row, ensure_ascii=False))
+        sys.stdout.flush()
+
+    failures = 0
+    used = {}
+    pending = {}
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=initWorker) as executor:
+        futures = {
+            executor.submit(hashFile, source): source for source, _ in files
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    "source": futures[future],
+                    "hash": None,
+                    "seconds": 0.0,
+                    "error": f"{type(e).__name__}: {e}",
+                }
+            source, digest = result["source"], result["hash"]
+            if result["error"]:
+                failures += 1
+                emit(source, None, False, result["seconds"], None, result["error"])
+                continue
+
+            # Parsing depends on the extension, identical bytes in .md and .txt differ
+            key = os.path.splitext(source)[1].lower() + ":" + digest
+            if key in cache:
+                used[key] = cache[key]
+                emit(source, digest, True, result["seconds"], cache[key], None)
+            else:
+                pending.setdefault(key, []).append((source, digest))
+
+        futures = {
+            executor.submit(statisticsFile, sources[0][0]): key
+            for key, sources in pending.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {
+                    "seconds": 0.0,
+                    "statistics": None,
+                    "error": f"{type(e).__name__}: {e}",
+                }
+
+            if result["error"]:
+                failures += len(pending[key])
+            else:
+                used[key] = result["statistics"]
+
+            # Identical files are parsed once and reported for every path
+            for source, digest in pending[key]:
+                emit(
+                    source,
+                    digest,
+                    False,
+                    result["seconds"],
+                    result["statistics"],
+                    result["error"],
+                )
+
+    # Runs over other directories keep their entries, the ones used here move
+    # to the end and the least recently used are dropped beyond the limit
+    if not args.no_cache:
+        merged = {key: value for key, value in cache.items() if key not in used}
+        merged.update(used)
+        merged = dict(list(merged.items())[-statisticsCacheEntries:])
+        if list(merged.items()) != list(cache.items()):
+            saveStatisticsCache(args.cache, merged)
+
+    return 1 if failures else 0
+
+
+def runServer(argv):
+    # Entry point for the inference server in frozen builds, see modules.server
+    from llama_cpp.server.__main__ import main
+
+    sys.argv = ["SolidWriting serve"] + list(argv)
+    main()
+    return 0
+
+
+def runHeadless(argv):
+    if argv and argv[0] == "serve":
+        return runServer(argv[1:])
+
+    parser = argparse.ArgumentParser(prog="SolidWriting")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="Convert documents without the GUI")
+    convert.add_argument("paths", nargs="+", help="Files or directories")
+    convert.add_argument(
+        "--to",
+        required=True,
+        choices=[extension[1:] for extension in DocumentEngine.writeExtensions],
+    )
+    convert.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    convert.add_argument(
+        "--output", default=None, help="Output directory (default: next to source)"
+    )
+
+    stats = commands.add_parser(
+        "stats", help="Document statistics for files or directories"
+    )
+    stats.add_argument("paths", nargs="+", help="Files or directories")
+    stats.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    stats.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    stats.add_argument(
+        "--cache",
+        default=os.path.join(fallbackValues["cacheDirectory"], "statistics.json"),
+    )
+    stats.add_argument("--no-cache", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command == "convert":
+        return runConvert(args)
+    elif args.command == "stats":
+        return runStatistics(args)
+    return 2
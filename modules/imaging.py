@@ -0,0 +1,160 @@
+import base64
+import hashlib
+from collections import OrderedDict
+
+from PySide6.QtCore import QBuffer, QByteArray, QIODevice, QSize
+from PySide6.QtGui import QColor, QImage, QImageIOHandler, QImageReader
+
+
+class ImageEngine:
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_sources: int = 1024,
+        max_placeholders: int = 256,
+    ):
+        self.max_bytes = max_bytes
+        self.max_sources = max_sources
+        self.max_placeholders = max_placeholders
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.sources = OrderedDict()
+        self.placeholders = OrderedDict()
+
+    def decodeDataUrl(self, url: str):
+        if not url.startswith("data:") or "," not in url:
+            return None
+        header, payload = url.split(",", 1)
+        if header.endswith(";base64"):
+            return base64.b64decode(payload)
+        return None
+
+    def source(self, url: str):
+        # digest of the url -> (hash, original size); keying by the url itself would
+        # keep a second copy of every image's base64 text
+        key = hashlib.sha1(url.encode("utf-8")).digest()
+        if key in self.sources:
+            self.sources.move_to_end(key)
+            return self.sources[key]
+        data = self.decodeDataUrl(url)
+        if data is None:
+            return None
+        size = self.readImage(data, header_only=True)
+        if not size.isValid():
+            return None
+        entry = (hashlib.sha1(data).hexdigest(), size)
+        self.sources[key] = entry
+        while len(self.sources) > self.max_sources:
+            self.sources.popitem(last=False)
+        return entry
+
+    def readImage(self, data: bytes, target: QSize = None, header_only=False):
+        buffer = QBuffer()
+        buffer.setData(QByteArray(data))
+        buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(buffer)
+        reader.setAutoTransform(True)
+        if header_only:
+            size = reader.size()
+            buffer.close()
+            return size
+        if target is not None:
+            reader.setScaledSize(target)
+        image = reader.read()
+        buffer.close()
+        return image
+
+    def displaySize(self, size: QSize, max_width: float) -> QSize:
+        if size.width() <= max_width:
+            return QSize(size)
+        ratio = max_width / size.width()
+        return QSize(int(max_width), max(1, int(size.height() * ratio)))
+
+    def scaledImage(self, url: str, logical_size: QSize, device_scale: float):
+        entry = self.source(url)
+        if entry is None:
+            return None
+        image_hash, size = entry
+
+        scale = min(1.0, (logical_size.width() * device_scale) / size.width())
+        scale = round(scale, 2) or 0.01
+        key = (image_hash, scale)
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        target = QSize(
+            max(1, int(size.width() * scale)), max(1, int(size.height() * scale))
+        )
+        image = self.readImage(
+            self.decodeDataUrl(url), target if target != size else None
+        )
+        if image.isNull():
+            return None
+        # Keep the laid-out size equal to the logical size regardless of pixel count
+        image.setDevicePixelRatio(image.width() / max(1, logical_size.width()))
+
+        self.cache[key] = image
+        self.cache_bytes += image.sizeInBytes()
+        while self.cache_bytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= evicted.sizeInBytes()
+
+        return image
+
+    def originalImage(self, url: str, logical_size: QSize):
+        # Full resolution for printing, deliberately kept out of the LRU
+        data = self.decodeDataUrl(url)
+        if data is None:
+            return None
+        image = self.readImage(data)
+        if image.isNull():
+            return None
+        image.setDevicePixelRatio(image.width() / max(1, logical_size.width()))
+        return image
+
+    def placeholderImage(self, url: str, logical_size: QSize):
+        entry = self.source(url)
+        if entry is None:
+            return None
+        image_hash, size = entry
+        if image_hash in self.placeholders:
+            self.placeholders.move_to_end(image_hash)
+            return self.placeholders[image_hash]
+
+        preview = QSize(
+            max(1, logical_size.width() // 8), max(1, logical_size.height() // 8)
+        )
+        data = self.decodeDataUrl(url)
+        buffer = QBuffer()
+        buffer.setData(QByteArray(data))
+        buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(buffer)
+        # Only formats with native scaled decoding (JPEG) are cheap enough to preview
+        if reader.supportsOption(QImageIOHandler.ImageOption.ScaledSize):
+            reader.setScaledSize(preview)
+            image = reader.read()
+        else:
+            image = QImage()
+        buffer.close()
+
+        if image.isNull():
+            image = QImage(preview, QImage.Format_RGB32)
+            image.fill(QColor("#E0E0E0"))
+        image.setDevicePixelRatio(image.width() / max(1, logical_size.width()))
+        self.placeholders[image_hash] = image
+        while len(self.placeholders) > self.max_placeholders:
+            self.placeholders.popitem(last=False)
+        return image
+
+    def evict(self, image_hash: str):
+        # Drops every decoded scale of one image, the document shows its placeholder
+        for key in [key for key in self.cache if key[0] == image_hash]:
+            self.cache_bytes -= self.cache.pop(key).sizeInBytes()
+
+    def clear(self):
+        self.cache.clear()
+        self.cache_bytes = 0
+        self.sources.clear()
+        self.placeholders.clear()
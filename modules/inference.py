@@ -0,0 +1,784 @@
+import collections
+import hashlib
+import itertools
+import os
+import pickle
+import queue
+import threading
+import time
+
+import llama_cpp.llama_cpp as llama_lib
+import numpy as np
+import psutil
+from llama_cpp import Llama, LlamaRAMCache
+from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+from PySide6.QtCore import QObject, QThread, Signal
+
+from modules.server import RemoteLlama, connectServer
+
+# Every context action starts with the same tokens, so llama's prompt cache
+# evaluates the preamble once and the selected text once per selection.
+contextPreamble = (
+    "You are the writing assistant of SolidWriting, a word processor. "
+    "You receive a passage from the user's document followed by a task. "
+    "Answer in the language of the passage, be concise and use Markdown "
+    "only for emphasis, lists and code."
+)
+
+contextInstructions = {
+    "": "Respond to the text.",
+    "selected": "Respond to the text.",
+    "summary": "Summarize the text.",
+    "suggestions": "Suggest improvements to the text.",
+    "clarify": "Explain the text clearly in simpler words.",
+}
+
+
+def documentMessages(question, passages):
+    excerpts = "\n\n".join(passages)
+    return [
+        {
+            "role": "user",
+            "content": f"{contextPreamble}\n\nExcerpts from the document:\n{excerpts}"
+            f"\n\nTask: Answer using the excerpts. {question}",
+        }
+    ]
+
+
+def contextMessages(text, action=""):
+    instruction = contextInstructions.get(action, contextInstructions[""])
+    return [
+        {
+            "role": "user",
+            "content": f"{contextPreamble}\n\nText:\n{text}\n\nTask: {instruction}",
+        }
+    ]
+
+
+class ChatSession:
+    def __init__(self, model_path=None):
+        self.model_path = model_path
+        self.messages = []
+        self.state = None
+
+    def save(self, path, max_bytes=2 * 1024 * 1024 * 1024):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            pickle.dump(
+                {
+                    "model_path": self.model_path,
+                    "messages": self.messages,
+                    "state": self.state,
+                },
+                file,
+            )
+        os.replace(temporary, path)
+        ChatSession.evict(os.path.dirname(path), max_bytes, keep=path)
+
+    @staticmethod
+    def evict(directory, max_bytes, keep=None):
+        # Every document and model pair leaves a session with its KV state behind
+        entries = []
+        total = 0
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                total += stat.st_size
+                # The session just saved stays even when it alone is over the limit
+                if entry.path != keep:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        # Least recently used first, loads refresh the mtime
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    @staticmethod
+    def load(path, model_path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as file:
+                data = pickle.load(file)
+            if not isinstance(data, dict):
+                raise ValueError("not a chat session")
+        except Exception:
+            # Truncated or written by an incompatible version, start a fresh session
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        if data.get("model_path") != model_path:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        session = ChatSession(model_path)
+        session.messages = data.get("messages", [])
+        session.state = data.get("state")
+        return session
+
+
+class AdaptiveLookupDecoding(LlamaPromptLookupDecoding):
+    # Drafts tokens by matching n-grams of the prompt, which pays off when the
+    # answer repeats the selection and costs extra evaluation when it does not
+    def __init__(self, max_ngram_size=2, num_pred_tokens=10, threshold=0.3, warmup=32):
+        super(AdaptiveLookupDecoding, self).__init__(max_ngram_size, num_pred_tokens)
+        self.threshold = threshold
+        self.warmup = warmup
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+        self.drafted = 0
+        self.accepted = 0
+        self.enabled = True
+
+    def acceptance(self):
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def __call__(self, input_ids, /, **kwargs):
+        if self.previous is not None:
+            start, draft = self.previous
+            actual = input_ids[start : start + len(draft)]
+            matched = 0
+            for predicted, token in zip(draft, actual):
+                if predicted != token:
+                    break
+                matched += 1
+            self.drafted += len(draft)
+            self.accepted += matched
+            self.previous = None
+
+        # Plain decoding for the rest of the answer once drafts keep getting rejected
+        if self.drafted >= self.warmup and self.acceptance() < self.threshold:
+            self.enabled = False
+        if not self.enabled:
+            return np.array([], dtype=np.intc)
+
+        draft = super(AdaptiveLookupDecoding, self).__call__(input_ids, **kwargs)
+        if len(draft):
+            self.previous = (len(input_ids), draft)
+        return draft
+
+
+class InferenceRequest(QObject):
+    token = Signal(str)
+    completed = Signal(str)
+
+    def __init__(
+        self,
+        messages=None,
+        priority=0,
+        session=None,
+        task=None,
+        cacheable=False,
+        speculative=False,
+        needs_model=True,
+        parent=None,
+        **params,
+    ):
+        super(InferenceRequest, self).__init__(parent)
+        self.messages = messages or []
+        self.priority = priority
+        self.session = session
+        self.cacheable = cacheable
+        self.cached = False
+        # Editing-style answers may use prompt-lookup drafts when the model has them
+        self.speculative = speculative
+        self.decoding = None
+        self.metrics = None
+        self.trimmed = False
+        # task(llm) runs on the worker thread instead of a chat completion
+        self.task = task
+        # Loading, unloading and persisting must not bring back an unloaded model
+        self.needs_model = needs_model
+        self.params = params
+        self.cancellation = threading.Event()
+
+    def cancel(self):
+        self.cancellation.set()
+
+    def isCancelled(self):
+        return self.cancellation.is_set()
+
+
+class InferenceEngine(QThread):
+    priorityInteractive = 0
+    priorityBackground = 10
+
+    loadProgress = Signal(float)
+
+    def __init__(self, parent=None):
+        super(InferenceEngine, self).__init__(parent)
+        self.llm = None
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.active = None
+        self.session = None
+        self.response_cache = None
+        self.model_key = None
+        self.progress_callback = None
+        self.model_options = {}
+        self.embedding_llm = None
+        self.embedding_model_path = None
+        self.lookup = None
+        self.model_path = None
+        self.model_cache = None
+        self.last_used = time.monotonic()
+        # Generated tokens and seconds per decoding mode, for comparing lookup drafts
+        self.decoding_rates = {"standard": [0, 0.0], "lookup": [0, 0.0]}
+        # One record per chat completion, exported as JSON from the AI panel
+        self.metrics_log = collections.deque(maxlen=1000)
+        # (model path, text digest) -> token count, read by the GUI for the selection
+        self.token_counts = collections.OrderedDict()
+        self.token_lock = threading.Lock()
+
+    def setResponseCache(self, response_cache, model_key):
+        self.response_cache = response_cache
+        self.model_key = model_key
+
+    def setModel(self, llm, cache=None):
+        if self.llm is not None and self.llm is not llm:
+            # Free the weights now instead of whenever the last reference goes away
+            self.llm.close()
+        if llm is None and self.embedding_llm is not None:
+            self.embedding_llm.close()
+            self.embedding_llm = None
+        self.llm = llm
+        self.session = None
+        if llm is not None and cache is not None:
+            llm.set_cache(cache)
+
+    def loadModel(self, model_path, cache=None, **options):
+        # Runs as a task on the worker thread, which is the only thread touching the model
+        request = self.active
+
+        def reportProgress(progress, user_data):
+            self.loadProgress.emit(float(progress))
+            # Returning False aborts llama_model_load
+            return request is None or not request.isCancelled()
+
+        callback = llama_lib.llama_progress_callback(reportProgress)
+        defaultParams = llama_lib.llama_model_default_params
+
+        def progressParams():
+            params = defaultParams()
+            params.progress_callback = callback
+            return params
+
+        self.setModel(None)
+        if options.get("server"):
+            # Out of process: crashes and model memory stay outside the editor
+            llm = connectServer(
+                model_path,
+                options,
+                self.loadProgress.emit,
+                request.isCancelled if request is not None else None,
+            )
+        else:
+            # Llama() has no progress argument, it builds its model params from this factory
+            llama_lib.llama_model_default_params = progressParams
+            try:
+                llm = Llama(model_path, **options)
+            finally:
+                llama_lib.llama_model_default_params = defaultParams
+
+        # The model params keep a pointer to the callback
+        self.progress_callback = callback
+        self.model_path = model_path
+        self.model_cache = cache
+        self.model_options = options
+        self.lookup = options.get("draft_model")
+        self.setModel(llm, cache)
+        return ""
+
+    def ensureModel(self):
+        # Transparent reload after an idle unload, with mmap the weights usually
+        # come straight from the page cache
+        if isinstance(self.llm, RemoteLlama) and not self.llm.isAlive():
+            # The window owning the shared server was closed, start or find another
+            self.setModel(None)
+        if self.llm is None and self.model_path is not None:
+            self.loadModel(self.model_path, self.model_cache, **self.model_options)
+        self.last_used = time.monotonic()
+
+    def unloadModel(self, idle_seconds, llm):
+        # A request may have arrived after the idle timer fired
+        if self.llm is None or time.monotonic() - self.last_used < idle_seconds:
+            return ""
+        if self.session is not None:
+            self.session.state = self.llm.save_state()
+        self.setModel(None)
+        if isinstance(self.model_cache, LlamaRAMCache):
+            # The saved prefix states would keep up to the cache capacity in RAM,
+            # the reload starts with an empty cache of the same size
+            self.model_cache = LlamaRAMCache(
+                capacity_bytes=self.model_cache.capacity_bytes
+            )
+        return ""
+
+    def isResident(self):
+        return self.llm is not None
+
+    def isLocal(self):
+        return isinstance(self.llm, Llama)
+
+    def embedder(self):
+        # Generation contexts cannot pool embeddings, a second small context is
+        # opened on a dedicated embedding model or the mmap-shared chat model.
+        # It stays on the CPU, offloading would put the weights on the GPU twice.
+        if not self.isLocal():
+            raise RuntimeError("Document retrieval needs the in-process model.")
+        path = self.embedding_model_path or self.llm.model_path
+        if self.embedding_llm is None or self.embedding_llm.model_path != path:
+            if self.embedding_llm is not None:
+                self.embedding_llm.close()
+            self.embedding_llm = Llama(
+                path,
+                **dict(
+                    self.model_options,
+                    embedding=True,
+                    pooling_type=llama_lib.LLAMA_POOLING_TYPE_MEAN,
+                    n_ctx=512,
+                    n_batch=512,
+                    n_ubatch=512,
+                    n_gpu_layers=0,
+                    draft_model=None,
+                    server=False,
+                    verbose=False,
+                ),
+            )
+        return self.embedding_llm
+
+    def indexDocument(self, index, llm, limit=16):
+        # Small batches so queued interactive requests get the worker in between
+        embedder = self.embedder()
+        if index.model_path != embedder.model_path:
+            index.clear(embedder.model_path)
+        texts = index.pending(limit)
+        if texts:
+            index.add(texts, embedder.embed(texts, normalize=True))
+        return ""
+
+    def answerFromDocument(self, index, question, llm, k=4):
+        request = self.active
+        if not index.isEmpty():
+            vector = self.embedder().embed(question, normalize=True)
+            passages = index.search(vector, k)
+            if passages:
+                request.messages = documentMessages(question, passages)
+        return self.generate(request)
+
+    def complete(self, prefix, llm):
+        # Plain continuation for inline suggestions; the caller keeps the start of
+        # the prefix stable so llama's prefix matching only evaluates the new tail
+        request = self.active
+        if llm is None:
+            return ""
+        llm.draft_model = None
+        # Every finished completion would save the whole KV state into the prompt
+        # cache, too slow for a suggestion and it evicts the warmed preamble
+        cache = getattr(llm, "cache", None)
+        if cache is not None:
+            llm.set_cache(None)
+        chunks = []
+        try:
+            stream = llm.create_completion(prefix, stream=True, **request.params)
+            try:
+                for chunk in stream:
+                    if request.isCancelled():
+                        break
+                    text = chunk["choices"][0]["text"]
+                    if text:
+                        chunks.append(text)
+                        request.token.emit(text)
+            finally:
+                stream.close()
+        finally:
+            if cache is not None:
+                llm.set_cache(cache)
+        return "".join(chunks)
+
+    def runBatch(self, job, llm, limit=4):
+        # llama-cpp-python decodes one sequence per context, so units run one after
+        # another; they share the preamble, which the prompt cache evaluates once.
+        # A few units per request let interactive requests run in between.
+        request = self.active
+        for text in job.pending(limit):
+            if request.isCancelled():
+                break
+            response = self.stream(
+                request,
+                self.fitMessages(
+                    contextMessages(text, job.action), request.params["max_tokens"]
+                ),
+                **request.params,
+            )
+            if request.isCancelled():
+                break
+            job.record(text, response)
+        return ""
+
+    def warmPrefix(self, llm):
+        if llm is not None:
+            llm.create_chat_completion(messages=contextMessages(""), max_tokens=1)
+        return ""
+
+    def submit(self, request):
+        # FIFO within the same priority
+        self.requests.put((request.priority, next(self.sequence), request))
+        return request
+
+    def cancelAll(self):
+        active = self.active
+        if active is not None:
+            active.cancel()
+        with self.requests.mutex:
+            for _, _, request in self.requests.queue:
+                if request is not None:
+                    request.cancel()
+
+    def stop(self):
+        self.cancelAll()
+        self.requests.put((-1, next(self.sequence), None))
+        self.wait()
+        # The window saves the chat session after stopping, park its KV state
+        # before the model goes away
+        if self.session is not None and self.llm is not None:
+            self.session.state = self.llm.save_state()
+        # A shared server keeps running while other windows still use it
+        self.setModel(None)
+
+    def run(self):
+        while True:
+            _, _, request = self.requests.get()
+            if request is None:
+                break
+            if request.isCancelled():
+                request.completed.emit("")
+                continue
+
+            self.active = request
+            try:
+                if request.needs_model:
+                    self.ensureModel()
+                if request.task is not None:
+                    # Tasks that may not load the model do not use the KV cache either
+                    if self.llm is not None and request.needs_model:
+                        self.activateSession(request.session)
+                    response = request.task(self.llm)
+                else:
+                    response = self.generate(request)
+            except Exception as e:
+                response = f"Error: {str(e)}"
+            self.active = None
+            request.completed.emit(response or "")
+
+    def activateSession(self, session):
+        # The KV cache only holds one conversation, park the previous one before switching
+        if session is self.session:
+            return
+        if self.session is not None:
+            self.session.state = self.llm.save_state()
+        if session is not None and session.state is not None:
+            self.llm.load_state(session.state)
+        self.session = session
+
+    def persistSession(self, session, path):
+        if session is self.session and self.llm is not None:
+            session.state = self.llm.save_state()
+        session.save(path)
+
+    def generate(self, request):
+        if self.llm is None:
+            return "Error: No model loaded."
+
+        key = None
+        if (
+            request.cacheable
+            and request.session is None
+            and self.response_cache is not None
+        ):
+            key = self.response_cache.key(
+                self.model_key, request.params, request.messages
+            )
+            response = self.response_cache.get(key)
+            if response is not None:
+                request.cached = True
+                request.token.emit(response)
+                return response
+
+        try:
+            self.activateSession(request.session)
+            messages = request.messages
+            if request.session is not None:
+                # Prefix matching in llama re-evaluates only the tokens of the new turn
+                messages = request.session.messages + request.messages
+
+            reserve = request.params.get("max_tokens") or min(1024, self.llm.n_ctx() // 4)
+            fitted = self.fitMessages(messages, reserve)
+            request.trimmed = fitted is not messages
+            response = self.stream(request, fitted, **request.params)
+            if key is not None and not request.isCancelled():
+                self.response_cache.put(key, response)
+            if request.session is not None:
+                request.session.messages.extend(
+                    request.messages + [{"role": "assistant", "content": response}]
+                )
+            return response
+        except Exception as e:
+            return f"Error: {str(e)}"
+
+    def stream(self, request, messages, **params):
+        local = self.isLocal()
+        lookup = self.lookup if request.speculative and local else None
+        self.llm.draft_model = lookup
+        if lookup is not None:
+            lookup.reset()
+
+        chunks = []
+        first = None
+        # With the server backend the model memory is in its process
+        process = psutil.Process(None if local else self.llm.pid)
+        peak_rss = process.memory_info().rss
+        if local:
+            llama_lib.llama_perf_context_reset(self.llm.ctx)
+        started = time.perf_counter()
+        stream = self.llm.create_chat_completion(
+            messages=messages, stream=True, **params
+        )
+        try:
+            for chunk in stream:
+                # Checked between tokens, closing the stream stops llama's generate loop
+                if request.isCancelled():
+                    break
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    if first is None:
+                        first = time.perf_counter()
+                    chunks.append(content)
+                    request.token.emit(content)
+                    peak_rss = max(peak_rss, process.memory_info().rss)
+        finally:
+            stream.close()
+            self.llm.draft_model = None
+
+        self.recordMetrics(request, lookup, started, first, peak_rss, len(chunks))
+
+        if first is not None and len(chunks) > 1:
+            # Prompt evaluation is excluded, drafts only speed up generation
+            mode = "lookup" if lookup is not None else "standard"
+            seconds = time.perf_counter() - first
+            rate = self.decoding_rates[mode]
+            rate[0] += len(chunks) - 1
+            rate[1] += seconds
+            request.decoding = {
+                "mode": mode,
+                "tokens_per_second": (len(chunks) - 1) / max(seconds, 1e-6),
+                "acceptance": lookup.acceptance() if lookup is not None else None,
+            }
+        return "".join(chunks)
+
+    def recordMetrics(self, request, lookup, started, first, peak_rss, chunks):
+        finished = time.perf_counter()
+        if not self.isLocal():
+            # Only client-side timings cross the process boundary
+            request.metrics = {
+                "time": time.time(),
+                "model": os.path.basename(self.llm.model_path),
+                "backend": "server",
+                "n_ctx": self.llm.n_ctx(),
+                "decoding": "standard",
+                "ttft_ms": (first - started) * 1000 if first is not None else None,
+                "prompt_tokens": None,
+                "prompt_tokens_per_second": None,
+                "generated_tokens": chunks,
+                "generation_tokens_per_second": (
+                    (chunks - 1) / (finished - first)
+                    if first is not None and chunks > 1 and finished > first
+                    else None
+                ),
+                "context_fill": None,
+                "peak_rss_mb": peak_rss / (1024**2),
+                "cancelled": request.isCancelled(),
+            }
+            self.metrics_log.append(request.metrics)
+            return
+
+        # llama counts prompt tokens actually evaluated, prefix cache hits are not included
+        perf = llama_lib.llama_perf_context(self.llm.ctx)
+        request.metrics = {
+            "time": time.time(),
+            "model": os.path.basename(self.llm.model_path),
+            "backend": "local",
+            "file_type": self.llm.metadata.get("general.file_type"),
+            "n_ctx": self.llm.n_ctx(),
+            "n_batch": self.llm.n_batch,
+            "n_threads": self.llm.n_threads,
+            "decoding": "lookup" if lookup is not None else "standard",
+            "ttft_ms": (first - started) * 1000 if first is not None else None,
+            "prompt_tokens": perf.n_p_eval,
+            "prompt_tokens_per_second": (
+                perf.n_p_eval * 1000 / perf.t_p_eval_ms if perf.t_p_eval_ms else None
+            ),
+            "generated_tokens": perf.n_eval,
+            "generation_tokens_per_second": (
+                perf.n_eval * 1000 / perf.t_eval_ms if perf.t_eval_ms else None
+            ),
+            "context_fill": self.llm.n_tokens / self.llm.n_ctx(),
+            "peak_rss_mb": peak_rss / (1024**2),
+            "cancelled": request.isCancelled(),
+        }
+        self.metrics_log.append(request.metrics)
+
+    def decodingRate(self, mode):
+        tokens, seconds = self.decoding_rates[mode]
+        return tokens / seconds if seconds else None
+
+    def tokenKey(self, text):
+        return self.model_path, hashlib.sha1(text.encode("utf-8")).digest()
+
+    def cachedTokenCount(self, text):
+        # Safe from the GUI thread, it never touches the model
+        with self.token_lock:
+            return self.token_counts.get(self.tokenKey(text))
+
+    def countTokens(self, text):
+        key = self.tokenKey(text)
+        with self.token_lock:
+            count = self.token_counts.get(key)
+            if count is not None:
+                self.token_counts.move_to_end(key)
+                return count
+
+        count = len(self.llm.tokenize(text.encode("utf-8"), add_bos=False))
+        with self.token_lock:
+            self.token_counts[key] = count
+            while len(self.token_counts) > 4096:
+                self.token_counts.popitem(last=False)
+        return count
+
+    def countTask(self, text, llm):
+        if llm is not None:
+            self.countTokens(text)
+        return ""
+
+    def fitMessages(self, messages, reserve):
+        # Returns messages unchanged when they fit in n_ctx minus the reserved output
+        budget = max(64, self.llm.n_ctx() - reserve - 64)
+        # Chat template tokens are not in the contents, each message gets some slack
+        counts = [self.countTokens(message["content"]) + 8 for message in messages]
+        total = sum(counts)
+        if total <= budget:
+            return messages
+
+        # Oldest turns go first, the last message is the request itself
+        start = 0
+        while start < len(messages) - 1 and total > budget:
+            total -= counts[start]
+            start += 1
+        last = messages[-1]
+        excess = total - budget
+        if excess <= 0:
+            return messages[start:]
+
+        # The start and the end of the request are kept, the end holds the task
+        ids = self.llm.tokenize(last["content"].encode("utf-8"), add_bos=False)
+        keep = max(0, len(ids) - excess - 8)
+        tail = min(64, keep // 4)
+        content = self.llm.detokenize(ids[: keep - tail]).decode("utf-8", "ignore")
+        if tail:
+            content += "\n[...]\n" + self.llm.detokenize(ids[-tail:]).decode(
+                "utf-8", "ignore"
+            )
+        return messages[start:-1] + [dict(last, content=content)]
+
+    def chunkText(self, text, budget):
+        chunks = []
+        current = []
+        size = 0
+        for paragraph in text.split("\n"):
+            if not paragraph.strip():
+                continue
+            tokens = self.countTokens(paragraph)
+            if current and size + tokens > budget:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            if tokens > budget:
+                # A single paragraph larger than the budget is cut at token boundaries
+                ids = self.llm.tokenize(paragraph.encode("utf-8"), add_bos=False)
+                for start in range(0, len(ids), budget):
+                    chunks.append(
+                        self.llm.detokenize(ids[start : start + budget]).decode(
+                            "utf-8", "ignore"
+                        )
+                    )
+                continue
+            current.append(paragraph)
+            size += tokens
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+
+    def summarize(self, text, llm, rounds=4):
+        # Map-reduce: summarize context-sized chunks, then summarize the summaries
+        request = self.active
+        reserve = min(512, self.llm.n_ctx() // 4)
+        # Chat template tokens are not in the prompt text, keep some slack for them
+        overhead = self.countTokens(contextMessages("", "summary")[0]["content"]) + 64
+        budget = max(64, self.llm.n_ctx() - reserve - overhead)
+
+        chunks = self.chunkText(text, budget)
+        if len(chunks) <= 1:
+            return self.generate(request)
+
+        output = []
+
+        def emit(content):
+            output.append(content)
+            request.token.emit(content)
+
+        try:
+            for _ in range(rounds):
+                if len(chunks) <= 1 or request.isCancelled():
+                    break
+                partials = []
+                for index, chunk in enumerate(chunks):
+                    if request.isCancelled():
+                        break
+                    emit(f"**Part {index + 1}/{len(chunks)}**\n")
+                    partial = self.stream(
+                        request,
+                        contextMessages(chunk, "summary"),
+                        **dict(request.params, max_tokens=reserve),
+                    )
+                    output.append(partial)
+                    partials.append(partial)
+                    emit("\n\n")
+                chunks = self.chunkText("\n".join(partials), budget)
+
+            if not request.isCancelled():
+                emit("**Summary**\n")
+                # Partials left after the last round are all summarized together,
+                # fitMessages trims them if they still exceed the context
+                output.append(
+                    self.stream(
+                        request,
+                        self.fitMessages(
+                            contextMessages("\n".join(chunks), "summary"), reserve
+                        ),
+                        **request.params,
+                    )
+                )
+            return "".join(output)
+        except Exception as e:
+            return "".join(output) + f"Error: {str(e)}"
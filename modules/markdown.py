@@ -0,0 +1,125 @@
+import html
+import re
+
+listItem = re.compile(r"( *)([-*+]|\d{1,9}[.)])\s+(.*)")
+heading = re.compile(r"(#{1,6})\s+(.*)")
+escapable = set("\\`*_#-+.!()[]")
+
+
+def renderInline(line):
+    # One left to right scan; openers stay literal until a matching closer turns them into tags
+    pieces = []
+    openers = []
+    position = 0
+    length = len(line)
+
+    while position < length:
+        character = line[position]
+
+        if character == "\\" and position + 1 < length and line[position + 1] in escapable:
+            pieces.append(html.escape(line[position + 1]))
+            position += 2
+            continue
+
+        if character == "`":
+            end = line.find("`", position + 1)
+            if end > position + 1:
+                pieces.append(f"<code>{html.escape(line[position + 1 : end])}</code>")
+                position = end + 1
+            else:
+                pieces.append("`")
+                position += 1
+            continue
+
+        if character in "*_":
+            run = 2 if line.startswith(character * 2, position) else 1
+            marker = character * run
+            before = line[position - 1] if position else " "
+            after = line[position + run] if position + run < length else " "
+            can_open = not after.isspace()
+            can_close = not before.isspace()
+            if character == "_":
+                # Underscores inside words are literal, snake_case stays intact
+                can_open = can_open and not before.isalnum()
+                can_close = can_close and not after.isalnum()
+
+            if can_close and any(opener == marker for opener, _ in openers):
+                # Openers crossed by this closer can no longer match
+                while openers[-1][0] != marker:
+                    openers.pop()
+                _, index = openers.pop()
+                tag = "b" if run == 2 else "i"
+                pieces[index] = f"<{tag}>"
+                pieces.append(f"</{tag}>")
+            else:
+                if can_open:
+                    openers.append((marker, len(pieces)))
+                pieces.append(marker)
+            position += run
+            continue
+
+        end = position + 1
+        while end < length and line[end] not in "\\`*_":
+            end += 1
+        pieces.append(html.escape(line[position:end]))
+        position = end
+
+    return "".join(pieces)
+
+
+class MarkdownStream:
+    # Incremental Markdown to HTML. Each completed line is rendered once into a
+    # self-contained HTML unit, so the increments can be appended as they come.
+    # The unfinished last line is kept back and exposed through pending().
+    def __init__(self):
+        self.buffer = ""
+        self.fence = None
+
+    def pending(self):
+        return self.buffer
+
+    def feed(self, chunk):
+        if "\n" not in chunk:
+            self.buffer += chunk
+            return ""
+        lines = (self.buffer + chunk).split("\n")
+        self.buffer = lines.pop()
+        # Fence markers render to None and take no line of their own
+        rendered = (self.renderLine(line) for line in lines)
+        return "".join(unit + "<br>" for unit in rendered if unit is not None)
+
+    def finish(self):
+        line, self.buffer = self.buffer, ""
+        return (self.renderLine(line) or "") if line else ""
+
+    def renderLine(self, line):
+        stripped = line.strip()
+
+        if self.fence is not None:
+            if stripped.startswith(self.fence) and not stripped.strip(self.fence[0]):
+                self.fence = None
+                return None
+            code = html.escape(line).replace(" ", "&nbsp;")
+            return f"<code style='background-color:#e4e4e4;'>{code}</code>"
+
+        if stripped.startswith("```") or stripped.startswith("~~~"):
+            self.fence = stripped[:3]
+            return None
+
+        match = heading.fullmatch(stripped)
+        if match:
+            return f"<b>{renderInline(match.group(2))}</b>"
+
+        match = listItem.fullmatch(line)
+        if match:
+            indent, marker, text = match.groups()
+            bullet = marker if marker[0].isdigit() else "&bull;"
+            padding = "&nbsp;" * (2 + len(indent))
+            return f"{padding}{bullet} {renderInline(text)}"
+
+        return renderInline(line)
+
+
+def markdownToHtml(text):
+    stream = MarkdownStream()
+    return stream.feed(text) + stream.finish()
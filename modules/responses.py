@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, memory_entries=256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def modelFingerprint(model_path, sample_bytes=4 * 1024 * 1024):
+        # Hashing a multi-GB GGUF on every load is too slow, the header
+        # (metadata) and the tail (last tensors) identify the file well enough
+        size = os.path.getsize(model_path)
+        digest = hashlib.sha256(str(size).encode("utf-8"))
+        with open(model_path, "rb") as file:
+            digest.update(file.read(sample_bytes))
+            if size > sample_bytes:
+                file.seek(max(sample_bytes, size - sample_bytes))
+                digest.update(file.read(sample_bytes))
+        return digest.hexdigest()
+
+    def key(self, model, params, messages):
+        payload = json.dumps(
+            {"model": model, "params": params, "messages": messages},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as file:
+                response = json.load(file)["response"]
+            os.utime(self.path(key))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        self.remember(key, response)
+        return response
+
+    def put(self, key, response):
+        self.remember(key, response)
+        try:
+            temporary = self.path(key) + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump({"response": response}, file, ensure_ascii=False)
+            os.replace(temporary, self.path(key))
+            self.evict()
+        except OSError:
+            pass
+
+    def remember(self, key, response):
+        with self.lock:
+            self.memory[key] = response
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        # Least recently used first, hits refresh the mtime
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
@@ -0,0 +1,70 @@
+import threading
+
+import numpy as np
+
+
+class RetrievalIndex:
+    def __init__(self):
+        self.model_path = None
+        self.paragraphs = []
+        # One contiguous float32 row per embedded paragraph, texts[row] is its paragraph
+        self.texts = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.lock = threading.Lock()
+
+    def clear(self, model_path=None):
+        with self.lock:
+            self.model_path = model_path
+            self.texts = []
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def update(self, paragraphs):
+        # Unchanged paragraphs keep their rows, only new or edited ones become pending
+        with self.lock:
+            self.paragraphs = list(
+                dict.fromkeys(paragraph for paragraph in paragraphs if paragraph.strip())
+            )
+            rows = {text: row for row, text in enumerate(self.texts)}
+            keep = [rows[text] for text in self.paragraphs if text in rows]
+            if len(keep) != len(self.texts):
+                self.matrix = np.ascontiguousarray(self.matrix[keep])
+                self.texts = [self.texts[row] for row in keep]
+
+    def pending(self, limit=None):
+        with self.lock:
+            known = set(self.texts)
+            texts = [text for text in self.paragraphs if text not in known]
+        return texts[:limit] if limit else texts
+
+    def add(self, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.lock:
+            # The document may have changed while the batch was embedded
+            present = set(self.paragraphs)
+            rows = [row for row, text in enumerate(texts) if text in present]
+            if not rows:
+                return
+            if self.matrix.size:
+                self.matrix = np.vstack([self.matrix, vectors[rows]])
+            else:
+                self.matrix = np.ascontiguousarray(vectors[rows])
+            self.texts += [texts[row] for row in rows]
+
+    def isEmpty(self):
+        with self.lock:
+            return not self.texts
+
+    def search(self, vector, k=4):
+        with self.lock:
+            matrix, texts = self.matrix, self.texts
+            order = {text: position for position, text in enumerate(self.paragraphs)}
+        if not texts:
+            return []
+
+        scores = matrix @ np.asarray(vector, dtype=np.float32)
+        k = min(k, len(texts))
+        top = np.argpartition(-scores, k - 1)[:k]
+        # Passages read better in document order than by score
+        return sorted(
+            (texts[row] for row in top), key=lambda text: order.get(text, 0)
+        )
@@ -0,0 +1,372 @@
+import hashlib
+import http.client
+import json
+import os
+import queue
+import secrets
+import socket
+import subprocess
+import sys
+import time
+
+import psutil
+
+from modules.globals import fallbackValues
+
+
+class ServerClient:
+    # Keep-alive connections are reused, a connection whose stream was abandoned
+    # mid-answer is closed so the server notices and stops generating
+    def __init__(
+        self, host, port, api_key, pool_size=4, timeout=600, keepalive=4.0
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # uvicorn drops idle keep-alive connections after 5 s, older ones are not reused
+        self.keepalive = keepalive
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+        }
+        self.idle = queue.LifoQueue()
+
+    def newConnection(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def connection(self):
+        # Returns (connection, whether it came from the idle pool)
+        while True:
+            try:
+                connection, released = self.idle.get_nowait()
+            except queue.Empty:
+                return self.newConnection(), False
+            if time.monotonic() - released < self.keepalive:
+                return connection, True
+            connection.close()
+
+    def release(self, connection):
+        if self.idle.qsize() < self.pool_size:
+            self.idle.put((connection, time.monotonic()))
+        else:
+            connection.close()
+
+    def send(self, method, path, body=None):
+        payload = json.dumps(body) if body is not None else None
+        connection, reused = self.connection()
+        try:
+            connection.request(method, path, body=payload, headers=self.headers)
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            # Only a pooled connection that failed before the request went out is
+            # retried, a request the server may have received is never sent twice
+            if not reused:
+                raise
+            connection = self.newConnection()
+            connection.request(method, path, body=payload, headers=self.headers)
+        try:
+            return connection, connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+    def request(self, method, path, body=None):
+        connection, response = self.send(method, path, body)
+        data = response.read()
+        self.release(connection)
+        if response.status >= 400:
+            raise RuntimeError(f"Server error {response.status}: {data[:200]!r}")
+        return json.loads(data)
+
+    def stream(self, path, body):
+        connection, response = self.send("POST", path, body)
+        if response.status >= 400:
+            data = response.read()
+            self.release(connection)
+            raise RuntimeError(f"Server error {response.status}: {data[:200]!r}")
+
+        finished = False
+        try:
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    finished = True
+                    break
+                yield json.loads(data)
+        finally:
+            if finished:
+                response.read()
+                self.release(connection)
+            else:
+                connection.close()
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+
+
+class RemoteLlama:
+    # The subset of Llama the inference engine uses, served by a local
+    # OpenAI-compatible process. KV state stays in the server, whose prompt
+    # cache handles prefix reuse.
+    def __init__(
+        self, client, model_path, n_ctx, pid=None, info_path=None, user_path=None
+    ):
+        self.client = client
+        self.model_path = model_path
+        self.pid = pid
+        self.info_path = info_path
+        self.user_path = user_path
+        self.metadata = {}
+        self.n_tokens = None
+        self.n_batch = None
+        self.n_threads = None
+        self.draft_model = None
+        self._n_ctx = n_ctx
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def isAlive(self):
+        try:
+            self.client.request("GET", "/v1/models")
+            return True
+        except (OSError, RuntimeError, http.client.HTTPException, ValueError):
+            return False
+
+    def create_chat_completion(self, messages, stream=False, **params):
+        body = dict(params, messages=messages, stream=stream)
+        if stream:
+            return self.client.stream("/v1/chat/completions", body)
+        return self.client.request("POST", "/v1/chat/completions", body)
+
+    def create_completion(self, prompt, stream=False, **params):
+        body = dict(params, prompt=prompt, stream=stream)
+        if stream:
+            return self.client.stream("/v1/completions", body)
+        return self.client.request("POST", "/v1/completions", body)
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = self.client.request(
+            "POST", "/extras/tokenize", {"input": text.decode("utf-8", "ignore")}
+        )["tokens"]
+        return tokens if add_bos or not tokens else tokens[1:]
+
+    def detokenize(self, tokens):
+        return self.client.request(
+            "POST", "/extras/detokenize", {"tokens": list(tokens)}
+        )["text"].encode("utf-8")
+
+    def embed(self, *args, **kwargs):
+        raise RuntimeError("Embeddings are not available with the inference server.")
+
+    def save_state(self):
+        return None
+
+    def load_state(self, state):
+        pass
+
+    def set_cache(self, cache):
+        pass
+
+    def close(self):
+        self.client.close()
+        if self.info_path is not None:
+            releaseServer(self.info_path, self.pid, self.user_path)
+            self.info_path = None
+
+
+def serverCommand():
+    # Frozen builds have no interpreter to run -m, they serve through the headless entry
+    if getattr(sys, "frozen", False):
+        return [sys.executable, "serve"]
+    return [sys.executable, "-m", "llama_cpp.server"]
+
+
+def freePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def serverInfoPath(model_path, options):
+    # One server per model and context size on this machine, shared by all windows
+    key = f"{os.path.abspath(model_path)}|{options.get('n_ctx')}|{options.get('n_gpu_layers')}"
+    return os.path.join(
+        fallbackValues["cacheDirectory"],
+        "servers",
+        hashlib.sha1(key.encode("utf-8")).hexdigest()[:16] + ".json",
+    )
+
+
+def serverUsersPath(info_path):
+    return os.path.splitext(info_path)[0] + ".users"
+
+
+def serverConfigPath(info_path):
+    return os.path.splitext(info_path)[0] + ".config.json"
+
+
+def registerUser(info_path):
+    # One file per client named <pid>-<token>, windows in one process count separately
+    directory = serverUsersPath(info_path)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}-{secrets.token_hex(4)}")
+    open(path, "w").close()
+    return path
+
+
+def releaseServer(info_path, pid, user_path=None):
+    # The server is shared by every window on the machine, the last user stops it
+    if user_path is not None:
+        try:
+            os.remove(user_path)
+        except OSError:
+            pass
+
+    directory = serverUsersPath(info_path)
+    try:
+        users = os.listdir(directory)
+    except OSError:
+        users = []
+    # Windows that crashed never unregistered, only live processes count
+    for name in users:
+        owner = name.split("-", 1)[0]
+        if owner.isdigit() and psutil.pid_exists(int(owner)):
+            return
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+    info = readServerInfo(info_path)
+    if info is None or info.get("pid") != pid:
+        return
+    try:
+        process = psutil.Process(pid)
+        process.terminate()
+        process.wait(10)
+    except psutil.Error:
+        pass
+    for path in (info_path, serverConfigPath(info_path)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def readServerInfo(path):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def writePrivateJson(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + ".tmp"
+    # The API key keeps other users on the machine away from the server
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    os.replace(temporary, path)
+
+
+def connectServer(model_path, options, progress=None, cancelled=None, timeout=600):
+    info_path = serverInfoPath(model_path, options)
+    n_ctx = options.get("n_ctx", 2048)
+
+    info = readServerInfo(info_path)
+    if info is not None:
+        client = ServerClient("127.0.0.1", info["port"], info["api_key"])
+        user_path = registerUser(info_path)
+        llm = RemoteLlama(
+            client, model_path, n_ctx, info.get("pid"), info_path, user_path
+        )
+        if llm.isAlive():
+            return llm
+        client.close()
+        os.remove(user_path)
+
+    port = freePort()
+    api_key = secrets.token_hex(16)
+    model = {
+        "model": model_path,
+        "cache": True,
+        "cache_type": "ram",
+    }
+    for name in (
+        "n_ctx",
+        "n_batch",
+        "n_threads",
+        "n_threads_batch",
+        "n_gpu_layers",
+        "offload_kqv",
+        "flash_attn",
+        "use_mmap",
+        "use_mlock",
+        "seed",
+    ):
+        if name in options:
+            model[name] = options[name]
+
+    # Settings go through a 0600 config file, the command line is readable by every
+    # user on the machine and would expose the API key
+    config_path = serverConfigPath(info_path)
+    writePrivateJson(
+        config_path,
+        {
+            "host": "127.0.0.1",
+            "port": port,
+            "api_key": api_key,
+            # Requests from several windows queue instead of cancelling each other
+            "interrupt_requests": False,
+            "models": [model],
+        },
+    )
+    command = serverCommand() + ["--config_file", config_path]
+
+    log_path = os.path.splitext(info_path)[0] + ".log"
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT
+        )
+
+    client = ServerClient("127.0.0.1", port, api_key)
+    try:
+        probe = RemoteLlama(client, model_path, n_ctx)
+        started = time.monotonic()
+        while not probe.isAlive():
+            if process.poll() is not None:
+                raise RuntimeError(f"Inference server exited, see {log_path}")
+            if (cancelled is not None and cancelled()) or time.monotonic() - started > timeout:
+                process.terminate()
+                process.wait()
+                raise RuntimeError("Inference server did not start.")
+            if progress is not None:
+                # No load progress crosses the process boundary, this only shows activity
+                progress(min(0.95, (time.monotonic() - started) / 30))
+            time.sleep(0.25)
+    finally:
+        # The server read its settings at startup, the key stays only in the info file
+        os.remove(config_path)
+
+    writePrivateJson(
+        info_path,
+        {"port": port, "api_key": api_key, "pid": process.pid, "model": model_path},
+    )
+    llm = RemoteLlama(
+        client, model_path, n_ctx, process.pid, info_path, registerUser(info_path)
+    )
+    if progress is not None:
+        progress(1.0)
+    return llm
@@ -0,0 +1,35 @@
+from langdetect import DetectorFactory, detect
+
+
+class StatisticsEngine:
+    def compute(self, text: str) -> dict:
+        words = text.split()
+        character_count = len(text)
+        word_count = len(words)
+        line_count = text.count("\n") + 1
+
+        statistics = {
+            "characters": character_count,
+            "words": word_count,
+            "lines": line_count,
+            "avg_word_length": None,
+            "avg_line_length": None,
+            "uppercase": None,
+            "lowercase": None,
+            "language": None,
+        }
+
+        if word_count > 0 and character_count > 0:
+            statistics["avg_word_length"] = sum(len(word) for word in words) / word_count
+            statistics["avg_line_length"] = (character_count / line_count) - 1
+            statistics["uppercase"] = sum(1 for char in text if char.isupper())
+            statistics["lowercase"] = sum(1 for char in text if char.islower())
+
+            if word_count > 20:
+                try:
+                    DetectorFactory.seed = 0
+                    statistics["language"] = detect(text)
+                except Exception:
+                    statistics["language"] = None
+
+        return statistics
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import platform
+import struct
+import time
+
+import llama_cpp.llama_cpp as llama_lib
+import psutil
+from PySide6.QtCore import QSettings
+
+from modules.inference import contextPreamble
+
+ggufScalars = {
+    0: "<B",
+    1: "<b",
+    2: "<H",
+    3: "<h",
+    4: "<I",
+    5: "<i",
+    6: "<f",
+    7: "<?",
+    10: "<Q",
+    11: "<q",
+    12: "<d",
+}
+
+
+def readMetadata(model_path):
+    # Only the GGUF header is read, the weights are never touched
+    metadata = {}
+
+    def wanted():
+        architecture = metadata.get("general.architecture")
+        if architecture is None:
+            return False
+        return all(
+            f"{architecture}.{name}" in metadata
+            for name in (
+                "context_length",
+                "block_count",
+                "embedding_length",
+                "attention.head_count",
+                "attention.head_count_kv",
+            )
+        )
+
+    try:
+        with open(model_path, "rb") as file:
+
+            def readString():
+                (length,) = struct.unpack("<Q", file.read(8))
+                return file.read(length).decode("utf-8", "replace")
+
+            def readValue(kind):
+                if kind == 8:
+                    return readString()
+                if kind == 9:
+                    element, length = struct.unpack("<IQ", file.read(12))
+                    if element in ggufScalars:
+                        file.seek(length * struct.calcsize(ggufScalars[element]), 1)
+                    else:
+                        for _ in range(length):
+                            readValue(element)
+                    return None
+                layout = ggufScalars[kind]
+                return struct.unpack(layout, file.read(struct.calcsize(layout)))[0]
+
+            if file.read(4) != b"GGUF":
+                return metadata
+            version, _, count = struct.unpack("<IQQ", file.read(20))
+            if version < 2:
+                return metadata
+
+            for _ in range(count):
+                key = readString()
+                (kind,) = struct.unpack("<I", file.read(4))
+                metadata[key] = readValue(kind)
+                if wanted():
+                    break
+    except (OSError, KeyError, struct.error):
+        pass
+    return metadata
+
+
+class InferenceTuner:
+    batchCandidates = (128, 256, 512)
+    contextCandidates = (2048, 4096, 8192, 16384, 32768)
+    # Short enough that calibrating on a CPU adds seconds, not minutes, to the first load
+    calibrationTokens = 128
+    generationTokens = 8
+
+    def __init__(self, offload=False, logits_all=False):
+        self.offload = offload
+        self.logits_all = logits_all
+        self.physical_cores = psutil.cpu_count(logical=False) or os.cpu_count() or 1
+        self.logical_cores = psutil.cpu_count(logical=True) or self.physical_cores
+        memory = psutil.virtual_memory()
+        self.total_memory = memory.total
+        self.available_memory = memory.available
+
+    def machineKey(self):
+        machine = "|".join(
+            str(value)
+            for value in (
+                platform.node(),
+                platform.machine(),
+                platform.processor(),
+                self.physical_cores,
+                self.logical_cores,
+                self.total_memory // (1024**3),
+                self.offload,
+                self.logits_all,
+            )
+        )
+        return hashlib.sha1(machine.encode("utf-8")).hexdigest()[:16]
+
+    def profileKey(self, model_key):
+        return f"llmProfiles/{model_key[:16]}-{self.machineKey()}"
+
+    def loadProfile(self, model_key):
+        # Own QSettings instance, this runs on the inference worker
+        value = QSettings("berkaygediz", "SolidWriting").value(
+            self.profileKey(model_key)
+        )
+        try:
+            return json.loads(value) if value else None
+        except (TypeError, ValueError):
+            return None
+
+    def saveProfile(self, model_key, profile):
+        QSettings("berkaygediz", "SolidWriting").setValue(
+            self.profileKey(model_key), json.dumps(profile)
+        )
+
+    def threadCandidates(self):
+        cores = self.physical_cores
+        return sorted({max(1, cores // 2), max(1, cores - 1), cores})
+
+    def contextSize(self, model_path):
+        metadata = readMetadata(model_path)
+        architecture = metadata.get("general.architecture", "")
+
+        def value(name, default=None):
+            return metadata.get(f"{architecture}.{name}", default)
+
+        trained = value("context_length") or self.contextCandidates[1]
+        layers = value("block_count")
+        embedding = value("embedding_length")
+        heads = value("attention.head_count")
+        kv_heads = value("attention.head_count_kv", heads)
+
+        candidates = [size for size in self.contextCandidates if size <= trained]
+        if not candidates:
+            return trained
+        if not (layers and embedding and heads and kv_heads):
+            return min(candidates[-1], self.contextCandidates[1])
+
+        # f16 K and V per layer, sized for the grouped-query heads
+        kv_bytes = 2 * 2 * layers * embedding * kv_heads // heads
+        if self.logits_all:
+            # Draft decoding keeps float32 logits for every context position
+            kv_bytes += 4 * (value("vocab_size") or 65536)
+        budget = max(0, self.available_memory - os.path.getsize(model_path)) // 2
+        fitting = [size for size in candidates if size * kv_bytes <= budget]
+        if self.offload:
+            # Offloaded weights and KV cache live in device memory, which host RAM
+            # says nothing about, so offloaded contexts stay at a conservative size
+            fitting = [size for size in fitting if size <= self.contextCandidates[1]]
+        return fitting[-1] if fitting else candidates[0]
+
+    def initialProfile(self, model_path):
+        return {
+            "n_threads": self.physical_cores,
+            "n_threads_batch": self.physical_cores,
+            "n_batch": self.batchCandidates[-1],
+            "n_ctx": self.contextSize(model_path),
+            "calibrated": False,
+        }
+
+    def loadOptions(self, profile):
+        return {
+            "n_threads": profile["n_threads"],
+            "n_threads_batch": profile["n_threads_batch"],
+            "n_batch": profile["n_batch"],
+            "n_ctx": profile["n_ctx"],
+        }
+
+    def apply(self, llm, profile):
+        # Threads and the eval batch size can change without recreating the context
+        llm.n_batch = min(profile["n_batch"], llm.context_params.n_batch)
+        llm.n_threads = profile["n_threads"]
+        llm.n_threads_batch = profile["n_threads_batch"]
+        llm.context_params.n_threads = profile["n_threads"]
+        llm.context_params.n_threads_batch = profile["n_threads_batch"]
+        llama_lib.llama_set_n_threads(
+            llm.ctx, profile["n_threads"], profile["n_threads_batch"]
+        )
+
+    def measure(self, llm, tokens):
+        llm.reset()
+        started = time.perf_counter()
+        llm.eval(tokens)
+        prompt_rate = len(tokens) / max(time.perf_counter() - started, 1e-6)
+
+        started = time.perf_counter()
+        for token in tokens[: self.generationTokens]:
+            llm.eval([token])
+        generation_rate = self.generationTokens / max(
+            time.perf_counter() - started, 1e-6
+        )
+        llm.reset()
+        return prompt_rate, generation_rate
+
+    def calibrate(self, llm, profile, progress=None, cancelled=None):
+        text = contextPreamble
+        tokens = llm.tokenize(text.encode("utf-8"))
+        while len(tokens) < self.calibrationTokens:
+            text += " " + contextPreamble
+            tokens = llm.tokenize(text.encode("utf-8"))
+        tokens = tokens[: min(self.calibrationTokens, llm.n_ctx() // 2)]
+
+        # A batch at least as long as the prompt evaluates it in one step, so only
+        # smaller batches can be told apart; otherwise the profile's batch stays
+        batches = [
+            size
+            for size in self.batchCandidates
+            if size <= llm.context_params.n_batch and size < len(tokens)
+        ]
+        threads = self.threadCandidates()
+        total = len(threads) + len(batches)
+        step = 0
+
+        def report():
+            if progress is not None:
+                progress(step / total)
+            return cancelled is not None and cancelled()
+
+        # Threads first at the largest batch, then the batch size with the best prompt threads
+        best = dict(profile)
+        best_prompt = best_generation = 0.0
+        for n_threads in threads:
+            if report():
+                return None
+            self.apply(llm, dict(best, n_threads=n_threads, n_threads_batch=n_threads))
+            prompt_rate, generation_rate = self.measure(llm, tokens)
+            if prompt_rate > best_prompt:
+                best_prompt, best["n_threads_batch"] = prompt_rate, n_threads
+            if generation_rate > best_generation:
+                best_generation, best["n_threads"] = generation_rate, n_threads
+            step += 1
+
+        # A smaller batch has to beat the profile's batch measured with the best threads
+        for n_batch in batches:
+            if report():
+                return None
+            self.apply(llm, dict(best, n_batch=n_batch))
+            prompt_rate, _ = self.measure(llm, tokens)
+            if prompt_rate > best_prompt:
+                best_prompt, best["n_batch"] = prompt_rate, n_batch
+            step += 1
+
+        report()
+        best["calibrated"] = True
+        best["prompt_tokens_per_second"] = round(best_prompt, 1)
+        best["generation_tokens_per_second"] = round(best_generation, 1)
+        self.apply(llm, best)
+        return best